@@ -0,0 +1,266 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.
+#
+# Author: Jeffersson Abreu (ctw6av)
+
+"""
+End to end benchmark of the server to client pipeline
+
+Synthetic frames are written to a pipe read by a PhysicalDevice in
+the server process. They go through the event bus and the observers,
+are sent over a localhost TCP connection and written by a client
+VirtualDevice to an in-memory uinput backend. The generator, the
+server and the client run in their own processes, no root access
+is needed. Frames recorded by a server with --record can be run
+too, giving the load of a real device.
+
+Run from the repository root:
+
+    python -m benchmarks.pipeline [--duration SECS] [--recording FILE] [WORKLOAD ...]
+"""
+
+from benchmarks.workloads import WORKLOADS, Recorded, Workload, EVENT, pack
+from typing import List
+import devices.backends
+import devices.physical
+import devices.virtual
+import server.observers
+import client.client
+import server.server
+import multiprocessing
+import events.bus
+import argparse
+import asyncio
+import time
+import os
+
+
+# Seconds waited for the last frames to arrive
+SETTLE_TIME = 0.5
+
+# Frames packed in each write while flooding the pipeline
+FLOOD_BATCH = 64
+
+
+class BenchVirtualDevice(devices.virtual.VirtualDevice):
+    """ Virtual device measuring the latency of every frame """
+
+    # Shared by all instances of the client process
+    latencies: List[int] = []
+    frames = 0
+    first = 0
+    last = 0
+
+    def emit(self, buffer):
+        super().emit(buffer)
+
+        now = time.monotonic_ns() // 1000
+        cls = BenchVirtualDevice
+
+        if not cls.frames:
+            cls.first = now
+
+        cls.frames += 1
+        cls.last = now
+
+        if buffer:
+            sec, usec = EVENT.unpack_from(buffer)[:2]
+            cls.latencies.append(now - sec * 1000000 - usec)
+
+
+class BenchServer(server.server.TCPServer):
+    """ Give the focus to the client as soon as it connects """
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.focus.to_last_client()
+
+
+def serve(fd: int, workload: Workload, ports: multiprocessing.Queue):
+    """ Run the server pipeline reading frames from fd """
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    bus = events.bus.EventBus(loop)
+    server.observers.EventSender(bus)
+    server.observers.ShortcutListener(bus)
+    focus = server.observers.FocusEvents(bus)
+    grabber = server.observers.Grabber(bus)
+
+    # The device handler is the pipe written by the generator
+    simulated = devices.backends.SimulatedDevice(workload.info(), workload.capabilities(), fd=fd)
+    backend = devices.backends.MemoryBackend({workload.name: simulated})
+
+    device = devices.physical.PhysicalDevice(workload.name, 0, backend)
+    device.connect(bus)
+    device.register(loop)
+    grabber.add_device(device)
+
+    coro = loop.create_server(lambda: BenchServer(focus, [device.info]), '127.0.0.1', 0)
+    waiter = loop.run_until_complete(coro)
+    ports.put(waiter.sockets[0].getsockname()[1])
+    loop.run_forever()
+
+
+def receive(port: int, ready, done, results: multiprocessing.Queue):
+    """ Run the client pipeline until done is set """
+
+    # Devices announced by the server are created as ours
+    pool = devices.virtual.DevicePool(devices.backends.MemoryUinputBackend(), BenchVirtualDevice)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    coro = loop.create_connection(lambda: client.client.TCPClient(loop=loop, pool=pool), '127.0.0.1', port)
+    _, protocol = loop.run_until_complete(coro)
+
+    def poll():
+        if getattr(protocol, 'devices', None):
+            ready.set()
+
+        if done.is_set():
+            cls = BenchVirtualDevice
+            results.put((cls.frames, cls.first, cls.last, cls.latencies))
+            loop.stop()
+            return None
+
+        loop.call_later(0.01, poll)
+
+    poll()
+    loop.run_forever()
+
+
+def generate(fd: int, workload: Workload, duration: float, flood: bool, results: multiprocessing.Queue):
+    """ Write frames to fd at the workload rate or as fast as possible """
+
+    interval = 1 / workload.rate
+    start = time.monotonic()
+    deadline = start + duration
+    number = 0
+
+    while time.monotonic() < deadline:
+        if flood:
+            stamp = time.monotonic_ns() // 1000
+            os.write(fd, b''.join(pack(workload.frame(number + n), stamp) for n in range(FLOOD_BATCH)))
+            number += FLOOD_BATCH
+            continue
+
+        # Keep the pace without drifting
+        delay = start + number * interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        os.write(fd, pack(workload.frame(number), time.monotonic_ns() // 1000))
+        number += 1
+
+    os.close(fd)
+    results.put((number, time.monotonic() - start))
+
+
+def run(workload: Workload, duration: float, flood: bool) -> dict:
+    """
+    Drive a workload through the pipeline once
+    :param workload: Workload instance
+    :param duration: Seconds to generate frames for
+    :param flood: Generate frames as fast as possible instead of at the device rate
+    :return: Dict with the numbers measured
+    """
+
+    context = multiprocessing.get_context('fork')
+    ports, results, generated = context.Queue(), context.Queue(), context.Queue()
+    ready, done = context.Event(), context.Event()
+
+    reader, writer = os.pipe()
+
+    # Only the server may keep the reading end and only
+    # the generator the writing one, so EOF is delivered
+    srv = context.Process(target=serve, args=(reader, workload, ports), daemon=True)
+    srv.start()
+    os.close(reader)
+
+    port = ports.get(timeout=10)
+    cli = context.Process(target=receive, args=(port, ready, done, results), daemon=True)
+    cli.start()
+    ready.wait(timeout=10)
+
+    gen = context.Process(target=generate, args=(writer, workload, duration, flood, generated), daemon=True)
+    gen.start()
+    os.close(writer)
+
+    sent, elapsed = generated.get()
+    gen.join()
+
+    time.sleep(SETTLE_TIME)
+    done.set()
+    frames, first, last, latencies = results.get(timeout=10)
+
+    cli.join(timeout=5)
+    srv.terminate()
+    srv.join()
+
+    latencies.sort()
+
+    def percentile(percent):
+        if not latencies:
+            return float('nan')
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+    span = (last - first) / 1000000
+
+    return {
+        'sent': sent,
+        'received': frames,
+        'sent_fps': sent / elapsed,
+        'received_fps': frames / span if span else 0,
+        'p50': percentile(50),
+        'p99': percentile(99),
+        'p999': percentile(99.9),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Strino server to client pipeline.')
+    parser.add_argument('workloads', help=f"Workloads to run ({', '.join(WORKLOADS)})", nargs='*')
+    parser.add_argument('-d', '--duration', help='Seconds each run generates frames', type=float, default=5)
+    parser.add_argument('-r', '--recording', help='Also run the frames of a recording made with --record', type=str)
+    args = parser.parse_args()
+
+    workloads = dict(WORKLOADS)
+    names = args.workloads or list(WORKLOADS)
+
+    if args.recording:
+        workloads[Recorded.name] = Recorded(args.recording)
+
+        if not args.workloads:
+            names.append(Recorded.name)
+
+    for name in names:
+        if name not in workloads:
+            parser.error(f"Unknown workload {name}")
+
+    print(f"{'Workload':<12} {'Rate':>6} {'Frames':>8} {'p50 us':>8} {'p99 us':>8} {'p999 us':>8}"
+          f" {'Max fps':>10} {'Delivered':>10}")
+
+    for name in names:
+        workload = workloads[name]
+
+        paced = run(workload, args.duration, flood=False)
+        flooded = run(workload, args.duration, flood=True)
+
+        print(f"{name:<12} {workload.rate:>6} {paced['received']:>8} {paced['p50']:>8} {paced['p99']:>8}"
+              f" {paced['p999']:>8} {flooded['sent_fps']:>10.0f} {flooded['received_fps']:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
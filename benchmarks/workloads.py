@@ -0,0 +1,220 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.
+#
+# Author: Jeffersson Abreu (ctw6av)
+
+from devices.backends import EVENT
+from structures.bitset import Bitset
+from typing import Dict, List, Tuple
+import misc.recording
+import constants.ecodes
+
+
+EV_SYN = constants.ecodes.EV_SYN
+EV_KEY = constants.ecodes.EV_KEY
+EV_REL = constants.ecodes.EV_REL
+EV_ABS = constants.ecodes.EV_ABS
+EV_MSC = constants.ecodes.EV_MSC
+
+# Event codes used below, see linux/input-event-codes.h
+MSC_SCAN = 0x04
+REL_X, REL_Y, REL_WHEEL = 0x00, 0x01, 0x08
+BTN_LEFT, BTN_RIGHT, BTN_MIDDLE, BTN_TOUCH = 0x110, 0x111, 0x112, 0x14a
+ABS_X, ABS_Y = 0x00, 0x01
+ABS_MT_SLOT, ABS_MT_POSITION_X, ABS_MT_POSITION_Y, ABS_MT_TRACKING_ID = 0x2f, 0x35, 0x36, 0x39
+
+# Keys typed by the keyboard workload (q to p, a to l and z to m)
+# leaving out modifiers so no shortcut is ever matched
+TYPED_KEYS = list(range(16, 26)) + list(range(30, 39)) + list(range(44, 51))
+
+
+def pack(events: List[Tuple[int, int, int]], stamp: int) -> bytes:
+    """
+    Pack a frame of events followed by its EV_SYN. Generated
+    frames carry the value of time.monotonic_ns when they were
+    written, so the sink can measure the latency
+    :param events: List of (type, code, value)
+    :param stamp: Time of the frame in microseconds
+    :return: Packed struct input_event
+    """
+    sec, usec = divmod(stamp, 1000000)
+    frame = [EVENT.pack(sec, usec, ev_type, code, value) for ev_type, code, value in events]
+    frame.append(EVENT.pack(sec, usec, EV_SYN, 0, 0))
+    return b''.join(frame)
+
+
+def _absinfo(minimum: int, maximum: int) -> dict:
+    return {'value': 0, 'minimum': minimum, 'maximum': maximum, 'fuzz': 0, 'flat': 0, 'resolution': 0}
+
+
+class Workload(object):
+    """ Synthetic device producing frames at a given rate """
+
+    # Name shown in reports
+    name = ''
+
+    # Frames per second produced by the real device
+    rate = 0
+
+    def info(self) -> dict:
+        """ Device information as returned by PhysicalDevice._get_info """
+        return {
+            'bustype': 0x03,
+            'vendor': 0x1234,
+            'product': 0x5678,
+            'version': 1,
+            'name': f'Strino benchmark {self.name}',
+            'phys': f'strino/benchmark/{self.name}',
+            'unique': '',
+            'prop': bytes(4),
+        }
+
+    def capabilities(self) -> Dict[int, list]:
+        """ Capabilities as returned by PhysicalDevice._get_capabilities """
+        raise NotImplementedError
+
+    def frame(self, number: int) -> List[Tuple[int, int, int]]:
+        """
+        Build the events of a frame
+        :param number: Sequence number of the frame
+        :return: List of (type, code, value)
+        """
+        raise NotImplementedError
+
+
+class Keyboard(Workload):
+    """ Keys pressed and released, each with its scan code """
+
+    name = 'keyboard'
+    rate = 100
+
+    def capabilities(self):
+        return {
+            EV_SYN: Bitset.from_bits([EV_SYN, EV_KEY, EV_MSC]),
+            EV_KEY: Bitset.from_bits(range(1, 128)),
+            EV_MSC: Bitset.from_bits([MSC_SCAN]),
+        }
+
+    def frame(self, number):
+        key = TYPED_KEYS[(number // 2) % len(TYPED_KEYS)]
+        return [(EV_MSC, MSC_SCAN, 0x70000 + key), (EV_KEY, key, 1 - number % 2)]
+
+
+class Mouse(Workload):
+    """ A 1000 Hz mouse moving in circles and scrolling now and then """
+
+    name = 'mouse'
+    rate = 1000
+
+    def capabilities(self):
+        return {
+            EV_SYN: Bitset.from_bits([EV_SYN, EV_KEY, EV_REL]),
+            EV_KEY: Bitset.from_bits([BTN_LEFT, BTN_RIGHT, BTN_MIDDLE]),
+            EV_REL: Bitset.from_bits([REL_X, REL_Y, REL_WHEEL]),
+        }
+
+    def frame(self, number):
+        step = number % 40
+        dx = 3 if step < 20 else -3
+        dy = 2 if 10 <= step < 30 else -2
+
+        if number % 100 == 0:
+            return [(EV_REL, REL_X, dx), (EV_REL, REL_Y, dy), (EV_REL, REL_WHEEL, 1)]
+
+        return [(EV_REL, REL_X, dx), (EV_REL, REL_Y, dy)]
+
+
+class Multitouch(Workload):
+    """ Two fingers dragged on a touch screen (type B protocol) """
+
+    name = 'multitouch'
+    rate = 240
+
+    def capabilities(self):
+        return {
+            EV_SYN: Bitset.from_bits([EV_SYN, EV_KEY, EV_ABS]),
+            EV_KEY: Bitset.from_bits([BTN_TOUCH]),
+            EV_ABS: [
+                (ABS_X, _absinfo(0, 4095)),
+                (ABS_Y, _absinfo(0, 4095)),
+                (ABS_MT_SLOT, _absinfo(0, 9)),
+                (ABS_MT_POSITION_X, _absinfo(0, 4095)),
+                (ABS_MT_POSITION_Y, _absinfo(0, 4095)),
+                (ABS_MT_TRACKING_ID, _absinfo(0, 65535)),
+            ],
+        }
+
+    def frame(self, number):
+        x = 1000 + number % 2000
+        y = 3000 - number % 2000
+
+        return [
+            (EV_ABS, ABS_MT_SLOT, 0),
+            (EV_ABS, ABS_MT_POSITION_X, x),
+            (EV_ABS, ABS_MT_POSITION_Y, y),
+            (EV_ABS, ABS_MT_SLOT, 1),
+            (EV_ABS, ABS_MT_POSITION_X, y),
+            (EV_ABS, ABS_MT_POSITION_Y, x),
+            (EV_KEY, BTN_TOUCH, 1),
+            (EV_ABS, ABS_X, x),
+            (EV_ABS, ABS_Y, y),
+        ]
+
+
+class Recorded(Workload):
+    """ Frames of the first device of a recording, played in a loop """
+
+    name = 'recorded'
+
+    def __init__(self, path: str):
+        recording = misc.recording.Recording(path)
+
+        if not recording.devices:
+            raise ValueError(f"{path} has no recorded devices")
+
+        self.device = dict(recording.devices[0])
+        self.events = self.device.pop('events')
+        index = self.device.pop('index')
+
+        frames = [(elapsed, frame) for elapsed, frame in recording.frames() if frame.index == index]
+        recording.close()
+
+        if not frames:
+            raise ValueError(f"{path} has no recorded frames")
+
+        self.frames = [list(frame) for _, frame in frames]
+
+        # Average rate the device produced frames at
+        span = frames[-1][0] - frames[0][0]
+        self.rate = round(len(frames) * 1e9 / span) if span else 1000
+
+    def info(self):
+        return dict(self.device)
+
+    def capabilities(self):
+        return self.events
+
+    def frame(self, number):
+        return self.frames[number % len(self.frames)]
+
+
+WORKLOADS = {workload.name: workload for workload in (Keyboard(), Mouse(), Multitouch())}
+
+
+__all__ = [
+    'WORKLOADS',
+    'Recorded',
+    'Workload',
+    'EVENT',
+    'pack'
+]
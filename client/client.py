@@ -15,14 +15,23 @@
 
 import networking.communication
 import constants.globals
+import devices.virtual
+import misc.tracing
 import asyncio
+import signal
 import time
-import sys
 
 
 class TCPClient(asyncio.Protocol):
 
-    def __init__(self, loop=None):
+    def __init__(self, loop=None, backend=None, pool=None):
+
+        # Virtual devices outlive the connection in the pool, devices
+        # are created with backend (uinput unless told otherwise)
+        self.pool = pool if pool is not None else devices.virtual.DevicePool(backend)
+
+        # Virtual devices by the index the server gave them
+        self.devices = {}
 
         self.events = networking.communication.Events()
         self.transport = None
@@ -42,41 +51,71 @@ class TCPClient(asyncio.Protocol):
     def connection_lost(self, exc):
         constants.globals.logger.info('The server closed the connection')
         constants.globals.logger.info(f'Reason: {exc if exc is not None else "Unknown reason"}')
+
+        # Keep the virtual devices for the next connection
+        for device in self.devices.values():
+            self.pool.release(device)
+        self.devices = {}
+
+        if misc.tracing.tracer is not None:
+            misc.tracing.tracer.log()
+
+        # Let connect_to connect again
         self.loop.stop()
-        sys.exit(1)
 
 
-def connect_to(addr, port):
+def connect_to(addr, port, trace: bool = False, backend=None, creation: str = 'parallel'):
     """ Connect the client to the server """
 
     loop = asyncio.get_event_loop()
 
-    while True:
-        # This try to connect us to server that should be
-        # waiting for connections in the most case. Once
-        # there is a possibility that some connection error
-        # occurs, the loop will try every 'X' seconds to
-        # connect to it.
-
-        try:
-            constants.globals.logger.info(f"Trying to connect to server at {addr}:{port}")
-            coro = loop.create_connection(lambda: TCPClient(loop=loop), addr, port)
-            loop.run_until_complete(coro)
-
-            # If connection is successful
-            # stop the loop and go on
-            break
-        except ConnectionRefusedError:
-            constants.globals.logger.info("Fail connecting to server")
-            constants.globals.logger.info("Trying again in 5 secs")
-            time.sleep(5)
+    if trace:
+        # Latencies are written to the log on SIGUSR1 and on exit
+        tracer = misc.tracing.enable(misc.tracing.CLIENT_STAGES)
+        loop.add_signal_handler(signal.SIGUSR1, tracer.log)
+
+    # Virtual devices are kept here between connections
+    pool = devices.virtual.DevicePool(backend, creation=creation)
+    protocol = None
 
     try:
-        loop.run_forever()
+        while True:
+            # This try to connect us to server that should be
+            # waiting for connections in the most case. Once
+            # there is a possibility that some connection error
+            # occurs, the loop will try every 'X' seconds to
+            # connect to it.
+
+            try:
+                constants.globals.logger.info(f"Trying to connect to server at {addr}:{port}")
+                coro = loop.create_connection(lambda: TCPClient(loop=loop, pool=pool), addr, port)
+                _, protocol = loop.run_until_complete(coro)
+            except OSError:
+                constants.globals.logger.info("Fail connecting to server")
+                constants.globals.logger.info("Trying again in 5 secs")
+                time.sleep(5)
+                continue
+
+            # Runs until the connection is lost, then
+            # we connect again keeping our devices
+            loop.run_forever()
+
     except KeyboardInterrupt:
         constants.globals.logger.info("Stopping the communication")
+
+        if misc.tracing.tracer is not None:
+            misc.tracing.tracer.log()
         loop.stop()
 
+        # Destroy the devices of the connection still running, if
+        # any, along with the ones kept for the next connection
+        if protocol is not None:
+            for device in protocol.devices.values():
+                pool.destroy(device)
+            protocol.devices = {}
+
+        pool.close()
+
 
 __all__ = [
     'TCPClient',
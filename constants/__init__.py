@@ -16,6 +16,7 @@
 __all__ = [
     'globals',
     'input',
+    'inotify',
     'ecodes',
     'llevel',
     'uinput'
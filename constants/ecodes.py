@@ -36,6 +36,28 @@ EV_PWR      = 0x16
 EV_FF_STATUS = 0x17
 EV_MAX      = 0x1f
 
+# Synchronization events codes
+SYN_REPORT      = 0x00
+SYN_CONFIG      = 0x01
+SYN_MT_REPORT   = 0x02
+SYN_DROPPED     = 0x03
+
+# Relative axes codes
+REL_X           = 0x00
+REL_Y           = 0x01
+
+# Multi touch axes, their values belong to the current slot
+ABS_MT_SLOT     = 0x2f
+ABS_MT_TOOL_Y   = 0x3d
+
+# Misc events codes
+MSC_SERIAL      = 0x00
+MSC_PULSELED    = 0x01
+MSC_GESTURE     = 0x02
+MSC_RAW         = 0x03
+MSC_SCAN        = 0x04
+MSC_TIMESTAMP   = 0x05
+
 # Dict to help in loops
 event_types = {
     'EV_SYN':		   EV_SYN,
@@ -19,6 +19,9 @@ import os
 # Add a base to build absolute path's
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# Keeps data that is slow to compute, like device capabilities
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.environ["HOME"], '.cache')), 'strino')
+
 logger = logging.getLogger()
 
 format_string = f'[%(levelname)s] [%(module)s] %(message)s'
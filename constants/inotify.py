@@ -0,0 +1,29 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.
+#
+# Author: Jeffersson Abreu (ctw6av)
+
+import struct
+
+# Flags of inotify_init1, see linux/inotify.h
+IN_NONBLOCK     =   0o4000
+IN_CLOEXEC      =   0o2000000
+
+# Events watched in a directory
+IN_ATTRIB       =   0x00000004      # Metadata changed (udev fixing permissions)
+IN_CREATE       =   0x00000100      # File created
+IN_DELETE       =   0x00000200      # File deleted
+
+# Fixed part of struct inotify_event (wd, mask, cookie and len),
+# followed by len bytes holding the NUL padded file name
+INOTIFY_EVENT = struct.Struct('iIII')
@@ -48,6 +48,9 @@ EVIOCGRAB = constants.llevel.iow('E', 0x90, ctypes.c_int)
 # Revoke device access
 EVIOCREVOKE = constants.llevel.iow('E', 0x91, ctypes.c_int)
 
+# Set the events delivered to a file handle
+EVIOCSMASK = constants.llevel.iow('E', 0x93, structures.input.InputMask)
+
 # Virtual bus
 BUS_VIRTUAL = 0x06
 
@@ -61,6 +64,33 @@ def EVIOCGPROP(length):
     return constants.llevel.ior(DEVICE_ID_BASE, 0x09, length)
 
 
+def EVIOCGKEY(length) -> int:
+    """
+    Get the keys and buttons held down
+    :param length: The length of string buffer (ctypes)
+    :return: Ioctl read operation number
+    """
+    return constants.llevel.ior(DEVICE_ID_BASE, 0x18, length)
+
+
+def EVIOCGLED(length) -> int:
+    """
+    Get the LEDs turned on
+    :param length: The length of string buffer (ctypes)
+    :return: Ioctl read operation number
+    """
+    return constants.llevel.ior(DEVICE_ID_BASE, 0x19, length)
+
+
+def EVIOCGSW(length) -> int:
+    """
+    Get the switches turned on
+    :param length: The length of string buffer (ctypes)
+    :return: Ioctl read operation number
+    """
+    return constants.llevel.ior(DEVICE_ID_BASE, 0x1b, length)
+
+
 def EVIOCGBIT(ev_type, length) -> int:
     """
     Get events bits
@@ -14,6 +14,9 @@
 # Author: Jeffersson Abreu (ctw6av)
 
 __all__ = [
+    'backends',
+    'cache',
+    'hotplug',
     'physical',
     'virtual'
 ]
\ No newline at end of file
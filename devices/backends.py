@@ -0,0 +1,571 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.
+#
+# Author: Jeffersson Abreu (ctw6av)
+
+from typing import Dict, Iterable, List, Optional, Tuple
+import constants.globals
+import constants.ecodes
+import constants.uinput
+import constants.input
+import structures.uinput
+import structures.input
+from structures.bitset import Bitset
+import devices.cache
+import threading
+import ctypes
+import struct
+import errno
+import fcntl
+import time
+import os
+
+
+# Packs a struct input_event from (sec, usec, type, code, value).
+# Both fields of its struct timeval are a long in the kernel
+EVENT = struct.Struct('@llHHi')
+
+
+# noinspection PyTypeChecker
+class EvdevBackend(object):
+    """ Talk to real devices in /dev/input with ioctl calls """
+
+    def __init__(self, cache: Optional[devices.cache.CapabilityCache] = None):
+
+        # Capabilities of devices seen before, probed again if None
+        self.cache = cache
+
+    def open(self, path: str, flags: int) -> int:
+        """
+        Open a device handler
+        :param path: Device handler path (E.g: /dev/input/event0)
+        :param flags: Flags given to os.open
+        :return: File descriptor
+        """
+        return os.open(path, flags)
+
+    def grab(self, fd: int) -> None:
+        """ Grab the device events visibility only for us """
+        fcntl.ioctl(fd, constants.input.EVIOCGRAB, 1)
+
+    def release(self, fd: int) -> None:
+        """ Give the device events back to the system, the handler stays open """
+        fcntl.ioctl(fd, constants.input.EVIOCGRAB, 0)
+
+    def set_mask(self, fd: int, masks: Dict[int, bytes]) -> None:
+        """
+        Tell the kernel which events to deliver to the handler
+        :param fd: Device handler file descriptor
+        :param masks: Bitmap of the codes delivered by event type, the
+                      event types delivered at 0. Others are untouched
+        :raise OSError: When the kernel does not support EVIOCSMASK
+        """
+        for ev_type, bitmap in masks.items():
+            codes = ctypes.create_string_buffer(bitmap, len(bitmap))
+            mask = structures.input.InputMask(ev_type, len(bitmap), ctypes.addressof(codes))
+            fcntl.ioctl(fd, constants.input.EVIOCSMASK, mask)
+
+    @staticmethod
+    def _get_identification(fd: int) -> Tuple[structures.input.InputId, str, str]:
+        """
+        Get the input id, name and physical topology of a device
+        :param fd: Device handler file descriptor
+        :return: Tuple (input id, name, phys)
+        """
+
+        # Create the string buffer to make future ioctl calls
+        name = ctypes.create_string_buffer(constants.input.MAX_NAME_SIZE)
+        phys = ctypes.create_string_buffer(constants.input.MAX_NAME_SIZE)
+
+        # Instantiate a struct input_id and and
+        # clean (fill 0) memory of it's address
+        iid = structures.input.InputId()
+        ctypes.memset(ctypes.addressof(iid), 0, ctypes.sizeof(iid))
+
+        # Get the file ID (type, vendor, product, version)
+        fcntl.ioctl(fd, constants.input.EVIOCGID, iid)
+
+        # Get the device name
+        fcntl.ioctl(fd, constants.input.EVIOCGNAME, name)
+
+        # Some devices do not have a physical topology associated with them
+        fcntl.ioctl(fd, constants.input.EVIOCGPHYS, phys)
+
+        return iid, name.value.decode(), phys.value.decode()
+
+    def get_info(self, fd: int) -> dict:
+        """
+        Get Device information by a given file descriptor
+        :param fd: Device handler file descriptor
+        :return: Dict containing information about device handled by file
+        """
+
+        uniq = ctypes.create_string_buffer(constants.input.MAX_NAME_SIZE)
+
+        prop = ctypes.create_string_buffer(constants.input.INPUT_PROP_CNT // 8)
+        fcntl.ioctl(fd, constants.input.EVIOCGPROP(prop), prop)
+
+        iid, name, phys = self._get_identification(fd)
+
+        try:
+            # Some kernels have started reporting bluetooth controller MACs as phys.
+            # This lets us get the real physical address. As with phys, it may be blank.
+            fcntl.ioctl(fd, constants.input.EVIOCGUNIQ, uniq)
+        except IOError:
+            pass
+
+        constants.globals.logger.info(f'Device name is "{name}"')
+
+        return {
+            'bustype': iid.bustype,
+            'vendor': iid.vendor,
+            'product': iid.product,
+            'version': iid.version,
+            'name': name,
+            'phys': phys,
+            'unique': uniq.value.decode(),
+            'prop': prop.raw,
+        }
+
+    @staticmethod
+    def _get_bitmaps(fd: int) -> Tuple[bytes, Dict[int, bytes]]:
+        """
+        Get the EVIOCGBIT bitmaps of a device
+        :param fd: Device handler file descriptor
+        :return: Tuple (event types bitmap, codes bitmap by event type)
+        """
+
+        # Create char arrays to be filed in ioctl calls. This char's
+        # array a will handle events and key codes related to event
+        ev_bits = ctypes.create_string_buffer(constants.ecodes.EV_MAX // 8 + 1)
+
+        # Get bits of all event types supported by device
+        fcntl.ioctl(fd, constants.input.EVIOCGBIT(0, ev_bits), ev_bits)
+        bitmaps = {}
+
+        for ev_type in Bitset(ev_bits.raw):
+            cd_bits = ctypes.create_string_buffer(constants.ecodes.KEY_MAX // 8 + 1)
+
+            try:
+                # Get all event codes related to the event type
+                fcntl.ioctl(fd, constants.input.EVIOCGBIT(ev_type, cd_bits), cd_bits)
+            except OSError:
+                # Sometime an argument error occurs we
+                # just break the loop and keep going
+                break
+
+            bitmaps[ev_type] = cd_bits.raw
+
+        return ev_bits.raw, bitmaps
+
+    def get_capabilities(self, fd: int) -> dict:
+        """
+        Return all device events supported and keys related. The
+        codes of every event type are kept as the bitmap given by
+        the kernel, except the axes that come with their ABS info.
+        The capabilities of devices seen before come from the cache
+        :param fd: Device handler file descriptor
+        :return: Dict with device capabilities
+        """
+
+        constants.globals.logger.info(f'Trying to get device information')
+
+        ev_bits, bitmaps = self._get_bitmaps(fd)
+        signature = ev_bits + b''.join(bitmaps.values())
+        fingerprint = None
+
+        if self.cache is not None:
+            iid, name, phys = self._get_identification(fd)
+            fingerprint = (iid.bustype, iid.vendor, iid.product, iid.version, name, phys)
+            capabilities = self.cache.get(fingerprint, signature)
+
+            if capabilities is not None:
+                constants.globals.logger.info(f'Capabilities of "{name}" found in cache')
+                return capabilities
+
+        # Build a dictionary of the device's capabilities
+        constants.globals.logger.info(f'Trying to get all events supported by the device')
+        capabilities = dict()
+
+        for ev_type, cd_bits in bitmaps.items():
+            codes = Bitset(cd_bits)
+
+            if ev_type != constants.ecodes.event_types['EV_ABS']:
+                # Just the event codes handled by the event type
+                capabilities[ev_type] = codes
+                continue
+
+            event = capabilities[ev_type] = []
+
+            for ev_code in codes:
+                abs_info = structures.input.ABSInfo()
+
+                # At this point we just check if event type is EV_ABS so clean the memory
+                # space of the instance of ABSInfo defined above and call the kernel to
+                # give us info about ABS device capabilities
+                ctypes.memset(ctypes.addressof(abs_info), 0, ctypes.sizeof(abs_info))
+                fcntl.ioctl(fd, constants.input.EVIOCGABS(ev_code), abs_info)
+
+                _abs = {
+                    'value': abs_info.value,
+                    'minimum': abs_info.minimum,
+                    'maximum': abs_info.maximum,
+                    'fuzz': abs_info.fuzz,
+                    'flat': abs_info.flat,
+                    'resolution': abs_info.resolution
+                }
+
+                # Save the ABS dict in a tuple numbered by event...
+                # Eg: (00, _abs)
+                event.append((ev_code, _abs))
+
+        for key in capabilities.keys():
+            for name, code in constants.ecodes.event_types.items():
+                if key == code:
+                    constants.globals.logger.info(f'Supported event: {name}')
+
+        if fingerprint is not None:
+            self.cache.put(fingerprint, signature, capabilities)
+
+        return capabilities
+
+    @staticmethod
+    def get_state(fd: int, capabilities: dict) -> List[Tuple[int, int, int]]:
+        """
+        Get the current value of every key, switch, LED and axis of
+        a device. Keys, switches and LEDs not held come with value 0
+        :param fd: Device handler file descriptor
+        :param capabilities: Capabilities of the device
+        :return: List of (type, code, value)
+        """
+        state = []
+
+        for ev_type, request in (
+                (constants.ecodes.EV_KEY, constants.input.EVIOCGKEY),
+                (constants.ecodes.EV_SW, constants.input.EVIOCGSW),
+                (constants.ecodes.EV_LED, constants.input.EVIOCGLED)):
+
+            codes = capabilities.get(ev_type)
+
+            if not codes:
+                continue
+
+            bits = ctypes.create_string_buffer(constants.ecodes.KEY_MAX // 8 + 1)
+            fcntl.ioctl(fd, request(bits), bits)
+            held = Bitset(bits.raw)
+
+            state.extend((ev_type, code, int(code in held)) for code in codes)
+
+        abs_info = structures.input.ABSInfo()
+
+        for ev_code, _ in capabilities.get(constants.ecodes.EV_ABS, ()):
+
+            # Multi touch values belong to a slot and can not be
+            # replayed without it, the touches are left as they are
+            if constants.ecodes.ABS_MT_SLOT <= ev_code <= constants.ecodes.ABS_MT_TOOL_Y:
+                continue
+
+            fcntl.ioctl(fd, constants.input.EVIOCGABS(ev_code), abs_info)
+            state.append((constants.ecodes.EV_ABS, ev_code, abs_info.value))
+
+        return state
+
+
+# noinspection PyTypeChecker
+class UinputBackend(object):
+    """ Create virtual devices with /dev/uinput """
+
+    def create(self, info: dict, events: dict) -> int:
+        """
+        Create a virtual device node
+        :param info: Device information as sent by the server
+        :param events: Device capabilities as sent by the server, the
+                       codes of an event type in any iterable (E.g: Bitset)
+        :return: File descriptor events are written to
+        """
+
+        try:
+            fd = os.open('/dev/uinput', os.O_RDWR | os.O_NONBLOCK)
+        except Exception as err:
+            constants.globals.logger.error('Error when opening uinput file')
+            raise err
+
+        # Prepare the setup and clean the memory space
+        usetup = structures.uinput.UinputSetup()
+        ctypes.memset(ctypes.addressof(usetup), 0, ctypes.sizeof(usetup))
+
+        # Set the device phys
+        fcntl.ioctl(fd, constants.uinput.UI_SET_PHYS, info.get('phys'))
+
+        # Fill the struct with our virtual device information
+        usetup.name = info['name'].encode()
+        usetup.id.product = info['product']
+        usetup.id.vendor = info['vendor']
+
+        # Set our bus different from the original info because now
+        # we are emulating the device so set bus as virtual
+        usetup.id.bustype = constants.input.BUS_VIRTUAL
+
+        # TODO: set FF bits
+
+        # For each event and codes [0, [1, 2, 3...]]
+        for event, codes in events.items():
+
+            # Set the event code bit
+            fcntl.ioctl(fd, constants.uinput.UI_SET_EVBIT, event)
+
+            if event == constants.ecodes.event_types.get("EV_SYN"):
+                constants.globals.logger.info('Setting up event EV_SYN')
+
+            if event == constants.ecodes.event_types.get("EV_MSC"):
+                constants.globals.logger.info('Setting up event EV_MSC')
+                for key in codes:
+                    fcntl.ioctl(fd, constants.uinput.UI_SET_MSCBIT, key)
+                continue
+
+            if event == constants.ecodes.event_types.get("EV_LED"):
+                constants.globals.logger.info('Setting up event EV_LED')
+                for key in codes:
+                    fcntl.ioctl(fd, constants.uinput.UI_SET_LEDBIT, key)
+                continue
+
+            if event == constants.ecodes.event_types.get("EV_KEY"):
+                constants.globals.logger.info('Setting up event EV_KEY')
+                for key in codes:
+                    fcntl.ioctl(fd, constants.uinput.UI_SET_KEYBIT, key)
+                continue
+
+            if event == constants.ecodes.event_types.get("EV_SND"):
+                constants.globals.logger.info('Not supported EV_SND yet!')
+                continue
+
+            if event == constants.ecodes.event_types.get("EV_SW"):
+                constants.globals.logger.info('Setting up event EV_SW')
+                for key in codes:
+                    fcntl.ioctl(fd, constants.uinput.UI_SET_SWBIT, key)
+                continue
+
+            if event == constants.ecodes.event_types.get("EV_REL"):
+                constants.globals.logger.info('Setting up event EV_REL')
+
+                for key in codes:
+                    fcntl.ioctl(fd, constants.uinput.UI_SET_RELBIT, key)
+                continue
+
+            if event == constants.ecodes.event_types.get("EV_ABS"):
+                constants.globals.logger.info('Setting up event EV_ABS')
+
+                # Define all structures we gonna use below
+                uinput_abs_setup = structures.uinput.UinputAbsSetup()
+                abs_info = structures.input.ABSInfo()
+
+                for key in codes:
+                    # (0 {value: 0, minimum: 0, maximum: 0, flat: 0, fuzz: 0, resolution: 0})
+                    _axis, _abs = key
+
+                    # Every single loop we fill 0 our structures to prevent memory trash in our structure
+                    ctypes.memset(ctypes.addressof(uinput_abs_setup), 0, ctypes.sizeof(uinput_abs_setup))
+                    ctypes.memset(ctypes.addressof(abs_info), 0, ctypes.sizeof(abs_info))
+
+                    # Activate the absolute movements for the axis
+                    fcntl.ioctl(fd, constants.uinput.UI_SET_ABSBIT, _axis)
+
+                    abs_info.value = _abs.get('value')
+                    abs_info.minimum = _abs.get('minimum')
+                    abs_info.maximum = _abs.get('maximum')
+                    abs_info.fuzz = _abs.get('fuzz')
+                    abs_info.flat = _abs.get('flat')
+                    abs_info.resolution = _abs.get('resolution')
+
+                    # Set the axis and the ABS info
+                    uinput_abs_setup.code = _axis
+                    uinput_abs_setup.absinfo = abs_info
+
+                    # Call ioctl to make our abs setup ;)
+                    fcntl.ioctl(fd, constants.uinput.UI_ABS_SETUP, uinput_abs_setup)
+
+                continue
+
+        # Setup the device prop bits
+        for bit in Bitset(info.get('prop')):
+            fcntl.ioctl(fd, constants.uinput.UI_SET_PROPBIT, bit)
+
+        # This ioctl sets parameters for the input device to be created
+        constants.globals.logger.info('Writing setup to kernel')
+        fcntl.ioctl(fd, constants.uinput.UI_DEV_SETUP, usetup)
+
+        # On UI_DEV_CREATE the kernel will create the device node for this
+        # device. We can start listening to the event, otherwise it will
+        # not notice the events we are about to send.
+        constants.globals.logger.info('Creating the device node')
+        fcntl.ioctl(fd, constants.uinput.UI_DEV_CREATE)
+
+        return fd
+
+    def destroy(self, fd: int) -> None:
+        """ Remove a virtual device node """
+        fcntl.ioctl(fd, constants.uinput.UI_DEV_DESTROY)
+        os.close(fd)
+
+
+class SimulatedDevice(object):
+    """ Device served by MemoryBackend """
+
+    def __init__(self, info: dict, capabilities: dict, frames: Iterable[List[Tuple[int, int, int]]] = (),
+                 rate: Optional[float] = None, fd: Optional[int] = None):
+
+        # What _get_info and _get_capabilities would return
+        self.info = info
+        self.capabilities = capabilities
+
+        # Every item is a frame, a list of (type, code, value)
+        # without the EV_SYN closing it. The device reaches its
+        # end when the iterable is exhausted
+        self.frames = frames
+
+        # Frames per second, as fast as possible when None
+        self.rate = rate
+
+        # Reading end of a pipe fed somewhere else (E.g: by another
+        # process), served as the device handler instead of frames
+        self.fd = fd
+
+        self.is_grabbed = False
+
+        # Values the device reports when queried, by (type, code).
+        # Anything missing is reported as 0
+        self.state: Dict[Tuple[int, int], int] = {}
+
+
+class MemoryBackend(object):
+    """
+    Serve simulated devices from memory. Opening a device gives
+    the reading end of a pipe fed with its frames by a thread,
+    so many devices can run in a single process without root
+    """
+
+    def __init__(self, devices: Dict[str, SimulatedDevice] = None):
+        self.devices: Dict[str, SimulatedDevice] = devices if devices is not None else {}
+
+        # Simulated devices by the file descriptor they were opened as
+        self._opened: Dict[int, SimulatedDevice] = {}
+
+    def add(self, path: str, device: SimulatedDevice) -> None:
+        """ Serve a simulated device at path """
+        self.devices[path] = device
+
+    def open(self, path: str, flags: int) -> int:
+        device = self.devices.get(path)
+
+        if device is None:
+            raise FileNotFoundError(path)
+
+        if device.fd is not None:
+            self._opened[device.fd] = device
+            return device.fd
+
+        reader, writer = os.pipe()
+        self._opened[reader] = device
+
+        feeder = threading.Thread(target=self._feed, args=(device, writer), daemon=True)
+        feeder.start()
+        return reader
+
+    @staticmethod
+    def _feed(device: SimulatedDevice, fd: int) -> None:
+        """ Write all frames of a simulated device to fd """
+        interval = 1 / device.rate if device.rate else 0
+        start = time.monotonic()
+        pack = EVENT.pack
+
+        try:
+            for number, events in enumerate(device.frames):
+                if interval:
+                    delay = start + number * interval - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                sec, usec = divmod(time.monotonic_ns() // 1000, 1000000)
+                frame = [pack(sec, usec, ev_type, code, value) for ev_type, code, value in events]
+                frame.append(pack(sec, usec, constants.ecodes.EV_SYN, 0, 0))
+                os.write(fd, b''.join(frame))
+        except BrokenPipeError:
+            pass
+        finally:
+            os.close(fd)
+
+    def grab(self, fd: int) -> None:
+        self._opened[fd].is_grabbed = True
+
+    def release(self, fd: int) -> None:
+        self._opened[fd].is_grabbed = False
+
+    def set_mask(self, fd: int, masks: Dict[int, bytes]) -> None:
+        # Simulated devices are filtered after being read
+        raise OSError(errno.ENOTTY, os.strerror(errno.ENOTTY))
+
+    def get_info(self, fd: int) -> dict:
+        return dict(self._opened[fd].info)
+
+    def get_capabilities(self, fd: int) -> dict:
+        return self._opened[fd].capabilities
+
+    def get_state(self, fd: int, capabilities: dict) -> List[Tuple[int, int, int]]:
+        values = self._opened[fd].state
+        state = []
+
+        for ev_type in (constants.ecodes.EV_KEY, constants.ecodes.EV_SW, constants.ecodes.EV_LED):
+            state.extend((ev_type, code, values.get((ev_type, code), 0)) for code in capabilities.get(ev_type, ()))
+
+        for ev_code, _ in capabilities.get(constants.ecodes.EV_ABS, ()):
+            if not constants.ecodes.ABS_MT_SLOT <= ev_code <= constants.ecodes.ABS_MT_TOOL_Y:
+                state.append((constants.ecodes.EV_ABS, ev_code, values.get((constants.ecodes.EV_ABS, ev_code), 0)))
+
+        return state
+
+
+class MemoryUinputBackend(object):
+    """
+    Create virtual devices that write to /dev/null. Every created
+    device is kept by the file descriptor it writes to
+    """
+
+    def __init__(self):
+        self.devices: Dict[int, dict] = {}
+
+    def create(self, info: dict, events: dict) -> int:
+        fd = os.open(os.devnull, os.O_WRONLY)
+        self.devices[fd] = dict(info, events=events)
+        return fd
+
+    def destroy(self, fd: int) -> None:
+        self.devices.pop(fd, None)
+        os.close(fd)
+
+
+# Backends used unless told otherwise
+EVDEV = EvdevBackend(devices.cache.CapabilityCache())
+UINPUT = UinputBackend()
+
+
+__all__ = [
+    'EVENT',
+
+    'MemoryUinputBackend',
+    'SimulatedDevice',
+    'MemoryBackend',
+    'UinputBackend',
+    'EvdevBackend',
+    'UINPUT',
+    'EVDEV'
+]
@@ -0,0 +1,105 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.
+#
+# Author: Jeffersson Abreu (ctw6av)
+
+from typing import Dict, Optional, Tuple
+import constants.globals
+import pickle
+import copy
+import os
+
+
+# Where the capabilities of the devices seen are kept
+CAPABILITIES_FILE = os.path.join(constants.globals.CACHE_DIR, 'capabilities')
+
+# Changed whenever the way capabilities are kept changes,
+# caches written in another format are thrown away
+CACHE_FORMAT = 2
+
+
+class CapabilityCache(object):
+    """
+    Capabilities of the devices seen before, saved on disk. A
+    device is known by its identification (bustype, vendor,
+    product, version, name and phys) and an entry is only used
+    while the EVIOCGBIT bitmaps of the device still match it
+    """
+
+    def __init__(self, path: str = CAPABILITIES_FILE):
+        self.path = path
+
+        # Loaded on first use so importing us costs nothing
+        self._entries: Optional[Dict[Tuple, Tuple[bytes, dict]]] = None
+
+    def _load(self) -> Dict[Tuple, Tuple[bytes, dict]]:
+        if self._entries is None:
+            try:
+                with open(self.path, 'rb') as file:
+                    version, self._entries = pickle.load(file)
+
+                if version != CACHE_FORMAT:
+                    self._entries = {}
+            except FileNotFoundError:
+                self._entries = {}
+            except Exception as error:
+                # A broken cache is rebuilt, never trusted
+                constants.globals.logger.warning(f"Ignoring capabilities cache {self.path}: {error}")
+                self._entries = {}
+
+        return self._entries
+
+    def get(self, fingerprint: Tuple, bitmaps: bytes) -> Optional[dict]:
+        """
+        Get the capabilities of a device seen before
+        :param fingerprint: Identification of the device
+        :param bitmaps: EVIOCGBIT bitmaps of the device, one after another
+        :return: Capabilities or None if unknown or changed
+        """
+        entry = self._load().get(fingerprint)
+
+        if entry is None or entry[0] != bitmaps:
+            return None
+
+        return copy.deepcopy(entry[1])
+
+    def put(self, fingerprint: Tuple, bitmaps: bytes, capabilities: dict) -> None:
+        """
+        Save the capabilities of a device
+        :param fingerprint: Identification of the device
+        :param bitmaps: EVIOCGBIT bitmaps of the device, one after another
+        :param capabilities: Capabilities as built by the backend
+        :return: None
+        """
+        entries = self._load()
+        entries[fingerprint] = (bitmaps, copy.deepcopy(capabilities))
+
+        # Write a new file and move it over the old one, so
+        # readers never see the cache half written
+        temporary = f"{self.path}.{os.getpid()}"
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+            with open(temporary, 'wb') as file:
+                pickle.dump((CACHE_FORMAT, entries), file)
+
+            os.replace(temporary, self.path)
+        except OSError as error:
+            constants.globals.logger.warning(f"Can not save capabilities cache {self.path}: {error}")
+
+
+__all__ = [
+    'CAPABILITIES_FILE',
+    'CapabilityCache'
+]
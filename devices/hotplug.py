@@ -0,0 +1,255 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.
+#
+# Author: Jeffersson Abreu (ctw6av)
+
+from devices.physical import PhysicalDevice
+from events.bus import EventBus, DEVICE_ADDED, DEVICE_REMOVED
+from typing import Dict, Iterable, List, Optional, Tuple
+from structures.bitset import Bitset
+from constants.inotify import *
+from threading import Thread
+import constants.globals
+import asyncio
+import ctypes
+import os
+
+
+# Where the kernel creates the event handlers
+INPUT_DIR = '/dev/input'
+
+# Bytes read from inotify at once, room for dozens of events
+INOTIFY_READ = 4096
+
+# Highest device index a message header can carry
+MAX_INDEX = 0xFFFF
+
+
+class Inotify(object):
+    """ Watch the entries of a directory with inotify """
+
+    def __init__(self, path: str, mask: int):
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        if libc.inotify_add_watch(self.fd, path.encode(), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, os.strerror(error), path)
+
+    def read(self) -> List[Tuple[int, str]]:
+        """
+        Read the changes waiting in the queue
+        :return: List of (mask, file name)
+        """
+        try:
+            data = os.read(self.fd, INOTIFY_READ)
+        except BlockingIOError:
+            return []
+
+        changes = []
+        offset = 0
+
+        while offset < len(data):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+
+            name = data[offset:offset + length].rstrip(b'\0').decode()
+            offset += length
+
+            changes.append((mask, name))
+
+        return changes
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class Hotplug(object):
+    """
+    Keep the shared devices in sync with the event handlers in
+    /dev/input. Only the handler that changed is probed, devices
+    named as one of the shared devices are shared once plugged
+    and unplugged devices are forgotten
+    """
+
+    def __init__(self, bus: EventBus, names: Iterable[str], backend=None, threaded: bool = False,
+                 filters: Dict[str, Dict[int, Optional[Bitset]]] = None):
+        self.bus = bus
+        self.backend = backend
+        self.threaded = threaded
+
+        # Events dropped by device name, * for every device
+        self.filters = filters if filters is not None else {}
+
+        # Names of the devices we share
+        self.names = set(names)
+
+        # Shared devices by handler path and the information
+        # sent to every client connecting, kept in sync
+        self.devices: Dict[str, PhysicalDevice] = {}
+        self.devices_info: List[dict] = []
+
+        # Indexes are not reused while the server runs, so a client
+        # or a recording never mistakes a new device for a gone one
+        self._next_index = 0
+
+        self.path = INPUT_DIR
+        self._inotify = None
+        self._loop = None
+
+    def filter_for(self, name: str) -> Dict[int, Optional[Bitset]]:
+        """
+        Get the events dropped from a device
+        :param name: Device name
+        :return: Dict of dropped codes by event type, None for the whole type
+        """
+        dropped = dict(self.filters.get('*', {}))
+
+        for ev_type, codes in self.filters.get(name, {}).items():
+            if ev_type in dropped and codes is not None and dropped[ev_type] is not None:
+                codes = Bitset.from_bits(set(codes) | set(dropped[ev_type]))
+            elif ev_type in dropped and dropped[ev_type] is None:
+                continue
+
+            dropped[ev_type] = codes
+
+        return dropped
+
+    def add(self, device: PhysicalDevice, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Share a device and start reading its events
+        :param device: PhysicalDevice instance
+        :param loop: Event loop of the server
+        :return: None
+        """
+        dropped = self.filter_for(device.name)
+
+        # Filtered before the device is announced to anyone
+        if dropped:
+            device.set_filter(dropped)
+
+        self.devices[device.handler_path] = device
+        self.devices_info.append(device.info)
+        self._next_index = max(self._next_index, device.index + 1)
+        self.names.add(device.name)
+
+        # Frames read from the device are published in the
+        # bus to the shortcut listener and the event sender
+        device.connect(self.bus, threadsafe=self.threaded)
+
+        if self.threaded:
+            # Start device reading events as daemon
+            Thread(target=device.read, daemon=True).start()
+            return None
+
+        # Let the event loop wake us up when there are events
+        device.register(loop)
+
+    def watch(self, loop: asyncio.AbstractEventLoop, path: str = INPUT_DIR) -> None:
+        """
+        Start watching handlers being created or deleted
+        :param loop: Event loop of the server
+        :param path: Directory holding the event handlers
+        :return: None
+        """
+        try:
+            self._inotify = Inotify(path, IN_CREATE | IN_ATTRIB | IN_DELETE)
+        except OSError as error:
+            constants.globals.logger.warning(f"Devices plugged will be ignored: {error}")
+            return None
+
+        self._loop = loop
+        self.path = path
+        loop.add_reader(self._inotify.fd, self._changed)
+
+    def _changed(self) -> None:
+        for mask, name in self._inotify.read():
+            if not name.startswith('event'):
+                continue
+
+            handler = os.path.join(self.path, name)
+
+            if mask & IN_DELETE:
+                self.unplugged(handler)
+                continue
+
+            # The handler may only be readable after udev
+            # changes its permissions, so both are tried
+            self.plugged(handler)
+
+    def _free_index(self) -> int:
+        """ Index never given to a shared device before """
+        if self._next_index <= MAX_INDEX:
+            return self._next_index
+
+        # Out of indexes the wire can carry, so the lowest
+        # one not used by a shared device is taken again
+        used = {device.index for device in self.devices.values()}
+        index = 0
+
+        while index in used:
+            index += 1
+
+        return index
+
+    def plugged(self, handler: str) -> None:
+        """ Probe a new handler and share it when we want it """
+        if handler in self.devices:
+            return None
+
+        try:
+            device = PhysicalDevice(handler, self._free_index(), self.backend)
+        except OSError as error:
+            constants.globals.logger.debug(f"Can not probe {handler} yet: {error}")
+            return None
+
+        if device.name not in self.names:
+            device.close()
+            return None
+
+        constants.globals.logger.info(f"Device {device.name} plugged at {handler}")
+        self.add(device, self._loop)
+        self.bus.publish(DEVICE_ADDED, device)
+
+    def unplugged(self, handler: str) -> None:
+        """ Forget a device whose handler was deleted """
+        device = self.devices.pop(handler, None)
+
+        if device is None:
+            return None
+
+        constants.globals.logger.info(f"Device {device.name} unplugged from {handler}")
+        self.devices_info.remove(device.info)
+
+        # Observers forget the device before its handler is closed
+        self.bus.publish(DEVICE_REMOVED, device)
+        device.close()
+
+    def close(self) -> None:
+        """ Stop watching the handlers """
+        if self._inotify is not None:
+            self._loop.remove_reader(self._inotify.fd)
+            self._inotify.close()
+            self._inotify = None
+
+
+__all__ = [
+    'Inotify',
+    'Hotplug'
+]
@@ -13,25 +13,75 @@
 #
 # Author: Jeffersson Abreu (ctw6av)
 
+from structures.frame import Frame, EVENT_SIZE, TYPE_OFFSET
+from typing import Dict, Iterable, Optional, Tuple
+import structures.input
+import structures.time
 from events.interfaces import Subject
+from structures.bitset import Bitset
+import devices.backends
 import constants.globals
 import constants.ecodes
-import constants.input
-import misc.utils
-import structures
-import ctypes
-import fcntl
-import sys
+import events.bus
+import misc.tracing
+import functools
+import asyncio
+import struct
+import errno
+import time
 import os
 
 
+# How many events are read from the kernel at once
+READ_EVENTS = 64
+
+# Used to peek the event type without building a ctypes structure
+EVENT_TYPE = struct.Struct('H')
+
+# Type and code of an event, to drop events after reading them
+EVENT_TYPE_CODE = struct.Struct('HH')
+
+# Peeks the code of EV_SYN events
+EVENT_CODE = struct.Struct('H')
+CODE_OFFSET = TYPE_OFFSET + EVENT_TYPE.size
+
+# Event types whose last value forwarded is kept to resync
+TRACKED = frozenset((
+    constants.ecodes.EV_KEY,
+    constants.ecodes.EV_SW,
+    constants.ecodes.EV_LED,
+    constants.ecodes.EV_ABS
+))
+
+
+def _allowed(dropped: Iterable[int], size: int) -> bytes:
+    """
+    Build a bitmap with every bit set but the dropped ones
+    :param dropped: Bits cleared
+    :param size: Number of bits in the bitmap
+    :return: Bytes
+    """
+    value = (1 << size) - 1
+
+    for bit in dropped:
+        value &= ~(1 << bit)
+
+    return value.to_bytes(size // 8, 'little')
+
+
 # noinspection PyTypeChecker
 class PhysicalDevice(Subject):
     """ Represents a physical device on the system """
 
-    def __init__(self, handler, *args, **kwargs):
+    def __init__(self, handler, index=0, backend=None, *args, **kwargs):
         Subject.__init__(self, *args, **kwargs)
 
+        # Small integer that identifies us on the wire
+        self.index = index
+
+        # Talks to the device, real evdev nodes unless told otherwise
+        self.backend = backend if backend is not None else devices.backends.EVDEV
+
         self.handler_path = handler
         self.handler = self._open(handler, os.O_RDWR)
 
@@ -39,31 +89,66 @@ class PhysicalDevice(Subject):
         self.capabilities = self._get_capabilities()
         self.info = self._get_info()
         self.info['events'] = self.capabilities
+        self.info['index'] = index
 
         # Keep a direct reference of our name
         self.name = self.info.get('name')
 
+        # Last value forwarded by (type, code). Clients create their
+        # devices with every key released and the axes announced
+        self._state: Dict[Tuple[int, int], int] = {
+            (constants.ecodes.EV_ABS, axis): info['value']
+            for axis, info in self.capabilities.get(constants.ecodes.EV_ABS, ())
+        }
+
+        # Events never forwarded, codes by event type or None for
+        # the whole type. Those the kernel does not drop for us are
+        # dropped after being read
+        self.dropped: Dict[int, Optional[Bitset]] = {}
+        self._drop: Optional[Dict[int, Optional[Bitset]]] = None
+
         self.is_grabbed = False
 
-    @staticmethod
-    def _open(file, flags):
-        """ Open the handle file device """
+        # Reading state shared by the blocking reader and the event
+        # loop reader. The kernel hands us as many whole events as fit
+        # in the buffer, so a single read drains a burst of them
+        self._buffer = bytearray(EVENT_SIZE * READ_EVENTS)
+        self._view = memoryview(self._buffer)
 
-        try:
-            return os.open(file, flags)
-        except Exception as error:
-            constants.globals.logger.fatal("Error while opening device handler file")
-            constants.globals.logger.fatal(error.__class__)
-            sys.exit(127)
+        # Keep events of a frame that was split between reads
+        self._pending = bytearray()
+
+        # Bytes of an incomplete event at the start of buffer. The
+        # kernel never splits events but pipes and sockets used in
+        # place of an evdev handler may do it
+        self._tail = 0
+
+        # Whether the kernel dropped events and the ones
+        # read until the next SYN_REPORT must be discarded
+        self._dropping = False
+
+        # Event loop we are registered with, if any
+        self._loop = None
+
+        # Frames are delivered to the attached observers
+        # unless we get connected to an event bus
+        self.publish = self.notify
+
+    def _open(self, file, flags):
+        """
+        Open the handle file device
+        :raise OSError: When the device can not be opened
+        """
+        return self.backend.open(file, flags)
 
     def grab(self):
         """ Grab the device events visibility only for us """
-        fcntl.ioctl(self.handler, constants.input.EVIOCGRAB, 1)
+        self.backend.grab(self.handler)
         self.is_grabbed = True
 
     def release(self):
-        """ Revoke the access to device """
-        fcntl.ioctl(self.handler, constants.input.EVIOCREVOKE, 0)
+        """ Share the device events with the system again """
+        self.backend.release(self.handler)
         self.is_grabbed = False
 
     def _get_info(self) -> dict:
@@ -71,126 +156,224 @@ class PhysicalDevice(Subject):
         Get Device information by a given file descriptor
         :return: Dict containing information about device handled by file
         """
+        return self.backend.get_info(self.handler)
 
-        # Create the string buffer to make future ioctl calls
-        name = ctypes.create_string_buffer(constants.input.MAX_NAME_SIZE)
-        phys = ctypes.create_string_buffer(constants.input.MAX_NAME_SIZE)
-        uniq = ctypes.create_string_buffer(constants.input.MAX_NAME_SIZE)
+    def _get_capabilities(self) -> dict:
+        """
+        Return all device events supported and keys related
+        :return: Dict with device capabilities
+        """
+        return self.backend.get_capabilities(self.handler)
 
-        prop = ctypes.create_string_buffer(constants.input.INPUT_PROP_CNT // 8)
-        fcntl.ioctl(self.handler, constants.input.EVIOCGPROP(prop), prop)
+    def set_filter(self, dropped: Dict[int, Optional[Bitset]]) -> None:
+        """
+        Stop forwarding some events. They are left out of our
+        capabilities, so clients never announce them, and pushed
+        into the kernel with EVIOCSMASK when it is supported
+        :param dropped: Codes dropped by event type, None drops the whole type
+        :return: None
+        """
+        capabilities = self.capabilities
 
-        # Instantiate a struct input_id and and
-        # clean (fill 0) memory of it's address
-        iid = structures.input.InputId()
-        ctypes.memset(ctypes.addressof(iid), 0, ctypes.sizeof(iid))
+        # EV_SYN closes every frame so it is never dropped
+        dropped = {
+            ev_type: codes for ev_type, codes in dropped.items()
+            if ev_type != constants.ecodes.EV_SYN and ev_type in capabilities
+        }
 
-        # Get the file ID (type, vendor, product, version)
-        fcntl.ioctl(self.handler, constants.input.EVIOCGID, iid)
+        types = []
 
-        # Get the device name
-        fcntl.ioctl(self.handler, constants.input.EVIOCGNAME, name)
+        for ev_type, codes in dropped.items():
+            if codes is None:
+                kept = None
+            elif ev_type == constants.ecodes.EV_ABS:
+                kept = [(axis, info) for axis, info in capabilities[ev_type] if axis not in codes]
+            else:
+                kept = Bitset.from_bits(code for code in capabilities[ev_type] if code not in codes)
+
+            if kept:
+                capabilities[ev_type] = kept
+                continue
 
-        # Some devices do not have a physical topology associated with them
-        fcntl.ioctl(self.handler, constants.input.EVIOCGPHYS, phys)
+            # No code of the type is left
+            capabilities.pop(ev_type)
+            types.append(ev_type)
+
+        if types and constants.ecodes.EV_SYN in capabilities:
+            supported = capabilities[constants.ecodes.EV_SYN]
+            capabilities[constants.ecodes.EV_SYN] = Bitset.from_bits(bit for bit in supported if bit not in types)
+
+        self.dropped = dropped
+        self._apply_filter()
+
+    def _apply_filter(self) -> None:
+        """ Push the filter into the kernel or drop events ourselves """
+        dropped = self.dropped
+
+        if not dropped:
+            self._drop = None
+            return None
+
+        masks = {}
+        types = [ev_type for ev_type, codes in dropped.items() if codes is None]
+
+        if types:
+            masks[constants.ecodes.EV_SYN] = _allowed(types, constants.ecodes.EV_MAX + 1)
+
+        for ev_type, codes in dropped.items():
+            if codes is not None:
+                masks[ev_type] = _allowed(codes, constants.ecodes.KEY_MAX + 1)
 
         try:
-            # Some kernels have started reporting bluetooth controller MACs as phys.
-            # This lets us get the real physical address. As with phys, it may be blank.
-            fcntl.ioctl(self.handler, constants.input.EVIOCGUNIQ, uniq)
-        except IOError:
-            pass
+            self.backend.set_mask(self.handler, masks)
+        except OSError:
+            constants.globals.logger.info(f"Filtering events of {self.name} after reading them")
+            self._drop = dropped
+            return None
 
-        constants.globals.logger.info(f'Device name is "{name.value.decode()}"')
-
-        return {
-            'bustype': iid.bustype,
-            'vendor': iid.vendor,
-            'product': iid.product,
-            'version': iid.version,
-            'name': name.value.decode(),
-            'phys': phys.value.decode(),
-            'unique': uniq.value.decode(),
-            'prop': prop.raw,
-        }
+        constants.globals.logger.info(f"Filtering events of {self.name} in the kernel")
+        self._drop = None
 
-    def _get_capabilities(self) -> dict:
+    def _filter(self, data: bytes) -> bytes:
         """
-        Return all device events supported and keys related
-        :return: Dict with device capabilities
+        Drop the filtered events of a frame
+        :param data: Packed events of a frame
+        :return: Packed events kept
         """
+        drop = self._drop
+        unpack = EVENT_TYPE_CODE.unpack_from
+        kept = []
+
+        for offset in range(0, len(data), EVENT_SIZE):
+            ev_type, code = unpack(data, offset + TYPE_OFFSET)
+
+            if ev_type in drop:
+                codes = drop[ev_type]
+                if codes is None or code in codes:
+                    continue
+
+            kept.append(data[offset:offset + EVENT_SIZE])
+
+        return b''.join(kept)
 
-        constants.globals.logger.info(f'Trying to get device information')
+    def _track(self, frame: Frame) -> None:
+        """ Keep the last value of every key, switch, LED and axis forwarded """
+        state = self._state
+        events = frame.events
 
-        # Create char arrays to be filed in ioctl calls. This char's
-        # array a will handle events and key codes related to event
-        cd_bits = ctypes.create_string_buffer(constants.ecodes.KEY_MAX // 8 + 1)
-        ev_bits = ctypes.create_string_buffer(constants.ecodes.EV_MAX // 8 + 1)
+        for position in range(0, len(events), 3):
+            ev_type = events[position]
+
+            if ev_type not in TRACKED:
+                continue
+
+            value = events[position + 2]
+
+            # Autorepeat does not change the state of a key
+            if ev_type == constants.ecodes.EV_KEY and value == 2:
+                continue
 
-        capabilities = dict()
+            state[(ev_type, events[position + 1])] = value
 
-        # Fill 0 (clean) the memory space of ev_bits and call ioctl to get bits of
-        # all event codes supported by device so we can build the device capabilities
-        constants.globals.logger.info(f'Trying to get all events supported by the device')
-        ctypes.memset(ctypes.addressof(ev_bits), 0, ctypes.sizeof(ev_bits))
-        fcntl.ioctl(self.handler, constants.input.EVIOCGBIT(0, ev_bits), ev_bits)
+    def _resync(self, stamp: int) -> None:
+        """
+        Publish a frame with the changes the kernel dropped, comparing
+        the current state of the device with the last one forwarded.
+        Only codes whose value changed are sent, so a key held through
+        the drop is not pressed nor released again
+        :param stamp: Stamp of the frame
+        :return: None
+        """
+        try:
+            current = self.backend.get_state(self.handler, self.capabilities)
+        except OSError as error:
+            constants.globals.logger.warning(f"Could not get the state of {self.name}: {error}")
+            return None
 
-        # Build a dictionary of the device's capabilities
-        for ev_type in range(0, constants.ecodes.EV_MAX):
-            if misc.utils.is_in_bitmask(ev_bits.raw, ev_type):
+        state = self._state
+        changed = []
 
-                try:
-                    # Fill 0 (clean) the memory space of cd_bits and call ioctl to get all
-                    # related event codes so we can build a list of codes handled by event
-                    ctypes.memset(ctypes.addressof(cd_bits), 0, ctypes.sizeof(cd_bits))
-                    fcntl.ioctl(self.handler, constants.input.EVIOCGBIT(ev_type, cd_bits), cd_bits)
-                except OSError:
-                    # Sometime an argument error occurs we
-                    # just break the loop and keep going
-                    break
+        for ev_type, code, value in current:
+            if state.get((ev_type, code), 0) != value:
+                state[(ev_type, code)] = value
+                changed.append((ev_type, code, value))
 
-                keyname = ev_type
+        if not changed:
+            return None
 
-                # if no error occurs so add the event key
-                capabilities[keyname] = []
+        pack = structures.input.InputEvent
+        sec, usec = divmod(time.time_ns() // 1000, 1000000)
+        timeval = structures.time.Timeval(sec, usec)
 
-                for ev_code in range(0, constants.ecodes.KEY_MAX):
-                    if misc.utils.is_in_bitmask(cd_bits.raw, ev_code):
+        data = b''.join(bytes(pack(timeval, ev_type, code, value)) for ev_type, code, value in changed)
+        self.publish(Frame(self.index, data, stamp))
 
-                        if ev_type == constants.ecodes.event_types['EV_ABS']:
-                            abs_info = structures.input.ABSInfo()
+    def connect(self, bus: events.bus.EventBus, threadsafe: bool = False) -> None:
+        """
+        Publish our frames to an event bus instead of notifying
+        observers. Readers running outside the event loop thread
+        should connect with threadsafe set
+        :param bus: EventBus instance
+        :param threadsafe: Whether frames are published from another thread
+        :return: None
+        """
+        publish = bus.publish_threadsafe if threadsafe else bus.publish
+        self.publish = functools.partial(publish, events.bus.DEVICE_FRAME)
 
-                            # At this point we just check if event type is EV_ABS so clean the memory
-                            # space of the instance of ABSInfo defined above and call the kernel to
-                            # give us info about ABS device capabilities
-                            ctypes.memset(ctypes.addressof(abs_info), 0, ctypes.sizeof(abs_info))
-                            fcntl.ioctl(self.handler, constants.input.EVIOCGABS(ev_code), abs_info)
+    def register(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Read events from the event loop thread instead of a
+        dedicated thread. The handler is made non blocking and
+        watched by the loop selector (epoll on Linux)
+        :param loop: Event loop that will read our events
+        :return: None
+        """
+        self._loop = loop
+        os.set_blocking(self.handler, False)
+        loop.add_reader(self.handler, self.read_events)
 
-                            _abs = {
-                                'value': abs_info.value,
-                                'minimum': abs_info.minimum,
-                                'maximum': abs_info.maximum,
-                                'fuzz': abs_info.fuzz,
-                                'flat': abs_info.flat,
-                                'resolution': abs_info.resolution
-                            }
+    def unregister(self) -> None:
+        """ Stop reading events from the event loop """
+        if self._loop is not None:
+            self._loop.remove_reader(self.handler)
+            self._loop = None
 
-                            # Get the event list and save the ABS
-                            # dict in a tuple numbered by event...
-                            # Eg: (00, _abs)
-                            event = capabilities[keyname]
-                            event.append((ev_code, _abs))
+    def close(self) -> None:
+        """ Stop reading events and close the handler """
+        self.unregister()
 
-                        else:
-                            # Just append the event code to event type key
-                            capabilities[keyname].append(ev_code)
+        if self.handler < 0:
+            return None
 
-        for key in capabilities.keys():
-            for name, code in constants.ecodes.event_types.items():
-                if key == code:
-                    constants.globals.logger.info(f'Supported event: {name}')
+        try:
+            os.close(self.handler)
+        except OSError:
+            pass
 
-        return capabilities
+        self.handler = -1
+
+    def _reopen(self) -> bool:
+        """
+        Reopen the handler keeping the reading mode
+        :return: False when the device is gone
+        """
+        loop = self._loop
+        self.close()
+
+        try:
+            self.handler = self._open(self.handler_path, os.O_RDWR)
+        except OSError:
+            constants.globals.logger.warning(f"Device {self.name} is gone")
+            return False
+
+        # Masks belong to the handler, so they are set again
+        if self.dropped:
+            self._apply_filter()
+
+        if loop is not None:
+            self.register(loop)
+
+        return True
 
     def read(self):
         """
@@ -201,39 +384,115 @@ class PhysicalDevice(Subject):
         event
         """
 
-        # Buffer size to read at time
-        buffer_length = ctypes.sizeof(structures.input.InputEvent)
-        event_list: [structures.input.InputEvent] = []
-
-        while True:
-            try:
-                # We need a blocking read as well to not
-                # spend machine power in a reading loop
-                buffer = os.read(self.handler, buffer_length)
-            except OSError:
-                # When releasing device from grab the read
-                # operation throws an OSError exception, so
-                # just reopen the handler and keep going
-                self.handler = self._open(self.handler_path, os.O_RDWR)
+        # We need a blocking read as well to not
+        # spend machine power in a reading loop
+        while self.read_events():
+            continue
+
+    def read_events(self) -> bool:
+        """
+        Make a single read from the handler and notify
+        observers about every frame completed by it
+        :return: False when the handler reached its end
+        """
+
+        size = EVENT_SIZE
+        publish = self.publish
+        buffer = self._buffer
+        view = self._view
+        pending = self._pending
+        drop = self._drop
+        tail = self._tail
+
+        try:
+            length = os.readv(self.handler, [view[tail:]])
+        except BlockingIOError:
+            # Nothing to read from a non blocking handler
+            return True
+        except OSError as error:
+            # The device was unplugged, stop reading it
+            if error.errno == errno.ENODEV:
+                constants.globals.logger.info(f"Device {self.name} was unplugged")
+                self.close()
+                return False
+
+            # The handler was revoked (E.g: by the session
+            # manager), so just reopen it and keep going
+            return self._reopen()
+
+        if not length:
+            # The device handler reached its end
+            self.unregister()
+            return False
+
+        # Frames are stamped only while tracing latencies
+        stamp = time.monotonic_ns() if misc.tracing.tracer is not None else 0
+
+        length += tail
+        tail = self._tail = length % size
+        length -= tail
+
+        # Start of the frame being built
+        start = 0
+
+        for offset in range(0, length, size):
+
+            # Only the event type is needed to find out
+            # if the event is different of EV_SYNC
+            if EVENT_TYPE.unpack_from(buffer, offset + TYPE_OFFSET)[0]:
+                continue
+
+            code = EVENT_CODE.unpack_from(buffer, offset + CODE_OFFSET)[0]
+
+            if code != constants.ecodes.SYN_REPORT:
+                if code == constants.ecodes.SYN_DROPPED:
+                    # The kernel buffer overflowed, so the frame being
+                    # built and the events up to the next SYN_REPORT
+                    # are incomplete and thrown away
+                    constants.globals.logger.warning(f"Events of {self.name} were dropped by the kernel")
+                    pending.clear()
+                    start = offset + size
+                    self._dropping = True
+
+                # SYN_MT_REPORT separates the touches of a frame
                 continue
 
-            # We instantiate an structure input_event and fill with
-            # buffer to check if event is different of EV_SYNC.
-            ie = structures.input.InputEvent.from_buffer_copy(buffer)
+            if self._dropping:
+                pending.clear()
+                start = offset + size
+                self._dropping = False
+                self._resync(stamp)
+                continue
+
+            # At this point the event is SYN_REPORT so the
+            # events before it are copied as one frame
+            if pending:
+                pending += view[start:offset]
+                data = bytes(pending)
+                pending.clear()
+            else:
+                data = bytes(view[start:offset])
+
+            start = offset + size
 
-            if ie.type:
+            if drop is not None:
+                data = self._filter(data)
 
-                # Event is not EV_SYNC so append
-                # to list and continue the loop
-                event_list.append(buffer)
+            # A lone EV_SYN (E.g: closing events the kernel
+            # masked) carries nothing worth sending
+            if not data:
                 continue
 
-            # At this point the event is EV_SYNC then
-            # we notify all observers attached to us
-            self.notify({
-                'data': event_list[:],
-                'name': self.name
-            })
+            # Then we notify all observers attached to us. The
+            # frame is decoded once here and shared by all of them
+            frame = Frame(self.index, data, stamp)
+            self._track(frame)
+            publish(frame)
+
+        if start < length:
+            pending += view[start:length]
+
+        if tail:
+            buffer[:tail] = view[length:length + tail]
 
-            # Should I comment? ;)
-            event_list.clear()
+        return True
@@ -13,164 +13,297 @@
 #
 # Author: Jeffersson Abreu (ctw6av)
 
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 import constants.globals
+import devices.backends
+import constants.ecodes
 import structures.input
-import structures.uinput
-import constants.uinput
-import misc.utils
-import ctypes
-import fcntl
+import structures.time
+import collections
+import asyncio
 import os
 
 
+# How virtual devices are created. In the event loop thread one after
+# another (inline), in worker threads all at once (parallel) or in
+# worker threads only when their first frame arrives (lazy)
+CREATION_MODES = ['inline', 'parallel', 'lazy']
+
+# Worker threads creating virtual devices at the same time
+CREATE_WORKERS = 4
+
+# Frames held for a device still being created, older ones are dropped
+PENDING_FRAMES = 256
+
+# What to do with a pending device once it is created
+ACTIVE, RELEASED, DESTROYED = range(3)
+
+
 # noinspection PyTypeChecker
 class VirtualDevice(object):
-    def __init__(self, device_info):
+    def __init__(self, device_info, backend=None):
 
-        try:
-            self.fd = os.open('/dev/uinput', os.O_RDWR | os.O_NONBLOCK)
-        except Exception as err:
-            constants.globals.logger.error('Error when opening uinput file')
-            raise err
+        # Creates the device node, uinput unless told otherwise
+        self.backend = backend if backend is not None else devices.backends.UINPUT
 
         self.events = device_info.pop('events')
         self.name = device_info.get('name')
         self.info = device_info
 
+        # Set by the DevicePool that created us
+        self.fingerprint = None
+
         constants.globals.logger.info(f'Emulating {self.name}')
+        self.fd = self.backend.create(self.info, self.events)
+
+        self.ev_sync = structures.input.InputEvent(structures.time.Timeval(0, 0), 0, 0, 0)
+
+        # Packed once to be written along with every frame
+        self.ev_sync_raw = bytes(self.ev_sync)
+
+    def emit(self, buffer):
+        """
+        Send the signal by writing to the early configured
+        file descriptor. File descriptor should be opened
+        using 'os' module. uinput takes many events in one
+        write, so the whole frame and the EV_SYN closing it
+        are written with a single syscall
+        :param buffer: Bytes-like object of packed input_event
+        """
+        os.writev(self.fd, [buffer, self.ev_sync_raw])
+        return None
+
+    def reset(self):
+        """
+        Release every key and button, the device may be left with
+        keys held down by a connection lost. The kernel drops the
+        releases of keys that are not pressed
+        """
+        keys = self.events.get(constants.ecodes.EV_KEY)
 
-        # Prepare the setup and clean the memory space
-        self.usetup = structures.uinput.UinputSetup()
-        ctypes.memset(ctypes.addressof(self.usetup), 0, ctypes.sizeof(self.usetup))
+        if keys:
+            pack = structures.input.InputEvent
+            timeval = structures.time.Timeval(0, 0)
+            self.emit(b''.join(bytes(pack(timeval, constants.ecodes.EV_KEY, key, 0)) for key in keys))
 
-        # Set the device phys
-        fcntl.ioctl(self.fd, constants.uinput.UI_SET_PHYS, self.info.get('phys'))
+        return None
 
-        # Fill the struct with our virtual device information
-        self.usetup.name = self.info['name'].encode()
-        self.usetup.id.product = self.info['product']
-        self.usetup.id.vendor = self.info['vendor']
+    def destroy(self):
+        """ Properly close the writer """
+        self.backend.destroy(self.fd)
+        constants.globals.logger.info(f'Device {self.info["name"]} destroyed')
+        return None
 
-        # Set our bus different from the original info because now
-        # we are emulating the device so set bus as virtual
-        self.usetup.id.bustype = constants.input.BUS_VIRTUAL
 
-        # TODO: set FF bits
+def _capabilities_key(events: dict) -> Tuple:
+    """
+    Make capabilities comparable, the current value of every
+    axis is left out since it changes while the device is used
+    :param events: Device capabilities as sent by the server
+    :return: Tuple
+    """
+    key = []
 
-        # For each event and codes [0, [1, 2, 3...]]
-        for event, codes in self.events.items():
+    for ev_type, codes in sorted(events.items()):
+        if ev_type == constants.ecodes.EV_ABS:
+            codes = tuple(
+                (axis, tuple(sorted((name, value) for name, value in absinfo.items() if name != 'value')))
+                for axis, absinfo in codes
+            )
+        else:
+            codes = tuple(codes)
 
-            # Set the event code bit
-            fcntl.ioctl(self.fd, constants.uinput.UI_SET_EVBIT, event)
+        key.append((ev_type, codes))
 
-            if event == constants.ecodes.event_types.get("EV_SYN"):
-                constants.globals.logger.info('Setting up event EV_SYN')
+    return tuple(key)
+
+
+class PendingDevice(object):
+    """
+    Stands for a virtual device being created by a worker thread,
+    so the event loop keeps handling messages meanwhile. Frames
+    emitted before the device exists are held and written in order
+    once it does. A lazy device is only created on its first frame
+    """
 
-            if event == constants.ecodes.event_types.get("EV_MSC"):
-                constants.globals.logger.info('Setting up event EV_MSC')
-                for key in codes:
-                    fcntl.ioctl(self.fd, constants.uinput.UI_SET_MSCBIT, key)
-                continue
+    def __init__(self, pool: 'DevicePool', info: dict, devices: dict, index: int, lazy: bool = False):
+        self.pool = pool
+        self.info = info
+        self.name = info.get('name')
 
-            if event == constants.ecodes.event_types.get("EV_LED"):
-                constants.globals.logger.info('Setting up event EV_LED')
-                for key in codes:
-                    fcntl.ioctl(self.fd, constants.uinput.UI_SET_LEDBIT, key)
-                continue
+        # Where the created device takes our place
+        self.devices = devices
+        self.index = index
 
-            if event == constants.ecodes.event_types.get("EV_KEY"):
-                constants.globals.logger.info('Setting up event EV_KEY')
-                for key in codes:
-                    fcntl.ioctl(self.fd, constants.uinput.UI_SET_KEYBIT, key)
-                continue
+        self.frames = collections.deque(maxlen=PENDING_FRAMES)
+        self.state = ACTIVE
+        self.future: Optional[asyncio.Future] = None
 
-            if event == constants.ecodes.event_types.get("EV_SND"):
-                constants.globals.logger.info('Not supported EV_SND yet!')
-                continue
+        if not lazy:
+            self.build()
 
-            if event == constants.ecodes.event_types.get("EV_SW"):
-                constants.globals.logger.info('Setting up event EV_SW')
-                for key in codes:
-                    fcntl.ioctl(self.fd, constants.uinput.UI_SET_SWBIT, key)
-                continue
+    def build(self) -> None:
+        """ Start creating the device in a worker thread """
+        loop = asyncio.get_event_loop()
+        self.future = loop.run_in_executor(self.pool.executor, self.pool.create, self.info)
+        self.future.add_done_callback(self._built)
 
-            if event == constants.ecodes.event_types.get("EV_REL"):
-                constants.globals.logger.info('Setting up event EV_REL')
+    def emit(self, buffer) -> None:
+        """ Hold a frame until the device is created """
+        self.frames.append(bytes(buffer))
 
-                for key in codes:
-                    fcntl.ioctl(self.fd, constants.uinput.UI_SET_RELBIT, key)
-                continue
+        if self.future is None:
+            self.build()
 
-            if event == constants.ecodes.event_types.get("EV_ABS"):
-                constants.globals.logger.info('Setting up event EV_ABS')
+    def _built(self, future: asyncio.Future) -> None:
+        error = future.exception()
 
-                # Define all structures we gonna use below
-                uinput_abs_setup = structures.input.UinputAbsSetup()
-                abs_info = structures.input.ABSInfo()
+        if error is not None:
+            constants.globals.logger.error(f'Can not create the virtual device of {self.name}: {error}')
+            if self.devices.get(self.index) is self:
+                self.devices.pop(self.index)
+            return None
 
-                for key in codes:
-                    # (0 {value: 0, minimum: 0, maximum: 0, flat: 0, fuzz: 0, resolution: 0})
-                    _axis, _abs = key
+        device = future.result()
 
-                    # Every single loop we fill 0 our structures to prevent memory trash in our structure
-                    ctypes.memset(ctypes.addressof(uinput_abs_setup), 0, ctypes.sizeof(uinput_abs_setup))
-                    ctypes.memset(ctypes.addressof(abs_info), 0, ctypes.sizeof(abs_info))
+        if self.state == DESTROYED:
+            device.destroy()
+            return None
 
-                    # Activate the absolute movements for the axis
-                    fcntl.ioctl(self.fd, constants.uinput.UI_SET_ABSBIT, _axis)
+        if self.state == RELEASED or self.devices.get(self.index) is not self:
+            self.pool.release(device)
+            return None
 
-                    abs_info.value = _abs.get('value')
-                    abs_info.minimum = _abs.get('minimum')
-                    abs_info.maximum = _abs.get('maximum')
-                    abs_info.fuzz = _abs.get('fuzz')
-                    abs_info.flat = _abs.get('flat')
-                    abs_info.resolution = _abs.get('resolution')
+        self.devices[self.index] = device
 
-                    # Set the axis and the ABS info
-                    uinput_abs_setup.code = _axis
-                    uinput_abs_setup.absinfo = abs_info
+        for frame in self.frames:
+            device.emit(frame)
 
-                    # Call ioctl to make our abs setup ;)
-                    fcntl.ioctl(self.fd, constants.uinput.UI_ABS_SETUP, uinput_abs_setup)
+        self.frames.clear()
 
-                continue
 
-        # Setup the device prop bits
-        for bit in range(constants.input.INPUT_PROP_CNT):
-            if misc.utils.is_in_bitmask(self.info.get('prop'), bit):
-                fcntl.ioctl(self.fd, constants.uinput.UI_SET_PROPBIT, bit)
+class DevicePool(object):
+    """
+    Virtual devices outliving the connection that created them.
+    A device announced again after a reconnect gets the node it
+    had before when it is the same device with the same
+    capabilities, saving hundreds of ioctl calls and leaving no
+    duplicated nodes behind. Nodes nobody claimed are destroyed
+    """
 
-        # This ioctl sets parameters for the input device to be created
-        constants.globals.logger.info('Writing setup to kernel')
-        fcntl.ioctl(self.fd, constants.uinput.UI_DEV_SETUP, self.usetup)
+    def __init__(self, backend=None, device_class=None, creation: str = 'parallel'):
+        self.backend = backend
 
-        # On UI_DEV_CREATE the kernel will create the device node for this
-        # device. We can start listening to the event, otherwise it will
-        # not notice the events we are about to send.
-        constants.globals.logger.info('Creating the device node')
-        fcntl.ioctl(self.fd, constants.uinput.UI_DEV_CREATE)
+        # Class of the devices created, VirtualDevice unless told otherwise
+        self.device_class = device_class if device_class is not None else VirtualDevice
+
+        # One of CREATION_MODES
+        self.creation = creation
+        self._executor = None
+
+        # Devices released by a connection, by fingerprint
+        self._idle: Dict[Tuple, List[VirtualDevice]] = {}
 
-        self.ev_sync = structures.input.InputEvent(structures.time.Timeval(0, 0), 0, 0, 0)
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """ Worker threads creating devices, started on first use """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(CREATE_WORKERS, thread_name_prefix='strino-uinput')
+        return self._executor
 
-    def emit(self, evs: list):
+    @staticmethod
+    def fingerprint(info: dict) -> Tuple:
+        """ Identification of a device and its capabilities """
+        return (
+            info.get('bustype'), info.get('vendor'), info.get('product'), info.get('version'),
+            info.get('name'), info.get('phys'), _capabilities_key(info.get('events', {}))
+        )
+
+    def create(self, info: dict) -> VirtualDevice:
         """
-        Send the signal by writing to the early configured
-        file descriptor. File descriptor should be opened
-        using 'os' module.
+        Create a new virtual device, may run in a worker thread
+        :param info: Device information as sent by the server
+        :return: VirtualDevice instance
         """
+        fingerprint = self.fingerprint(info)
+        device = self.device_class(info, self.backend)
+        device.fingerprint = fingerprint
+        return device
 
-        for evt in evs:
-            ie = structures.input.InputEvent.from_buffer_copy(evt)
-            # Write the event for file
-            os.write(self.fd, ie)
+    def claim(self, info: dict) -> Optional[VirtualDevice]:
+        """
+        Get an idle device matching a device announced
+        :param info: Device information as sent by the server
+        :return: VirtualDevice instance or None
+        """
+        idle = self._idle.get(self.fingerprint(info))
 
-        # Sync events written above
-        os.write(self.fd, self.ev_sync)
-        return None
+        if not idle:
+            return None
 
-    def destroy(self):
-        """ Properly close the writer """
-        fcntl.ioctl(self.fd, constants.uinput.UI_DEV_DESTROY)
-        constants.globals.logger.info(f'Device {self.info["name"]} destroyed')
-        os.close(self.fd)
-        return None
+        device = idle.pop()
+        device.info = info
+        device.info.pop('events')
+        constants.globals.logger.info(f'Reusing the virtual device of {device.name}')
+        return device
+
+    def attach(self, devices: dict, index: int, info: dict) -> None:
+        """
+        Give a device announced its virtual device, reused when
+        possible and otherwise created as the creation mode says
+        :param devices: Virtual devices of a connection by index
+        :param index: Index of the device announced
+        :param info: Device information as sent by the server
+        :return: None
+        """
+        device = self.claim(info)
+
+        if device is None:
+            if self.creation == 'inline':
+                device = self.create(info)
+            else:
+                device = PendingDevice(self, info, devices, index, lazy=self.creation == 'lazy')
+
+        devices[index] = device
+
+    def release(self, device: VirtualDevice) -> None:
+        """ Keep a device no longer used for a later connection """
+        if isinstance(device, PendingDevice):
+            device.state = RELEASED
+            return None
+
+        device.reset()
+        self._idle.setdefault(device.fingerprint, []).append(device)
+
+    def sweep(self) -> None:
+        """ Destroy every device nobody claimed """
+        idle = self._idle
+        self._idle = {}
+
+        for pending in idle.values():
+            for device in pending:
+                device.destroy()
+
+    def destroy(self, device: VirtualDevice) -> None:
+        """ Destroy a device that is gone for good """
+        if isinstance(device, PendingDevice):
+            device.state = DESTROYED
+            return None
+
+        device.destroy()
+
+    def close(self) -> None:
+        """ Destroy every idle device """
+        self.sweep()
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+__all__ = [
+    'CREATION_MODES',
+    'VirtualDevice',
+    'PendingDevice',
+    'DevicePool'
+]
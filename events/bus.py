@@ -0,0 +1,142 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.
+#
+# Author: Jeffersson Abreu (ctw6av)
+
+from typing import Any, AnyStr, Callable, Dict, List, Tuple
+import threading
+import asyncio
+
+
+# Topics published in the server. Frames read from a
+# physical device, devices plugged or unplugged while
+# running, clients connected or disconnected, shortcuts
+# matched in those frames, changes of the client in
+# focus and of the clients devices are routed to
+DEVICE_FRAME = 'device.frame'
+DEVICE_ADDED = 'device.added'
+DEVICE_REMOVED = 'device.removed'
+CLIENT_ADDED = 'client.added'
+CLIENT_REMOVED = 'client.removed'
+SHORTCUT = 'shortcut'
+FOCUS = 'focus'
+ROUTES = 'routes'
+
+
+class EventBus(object):
+    """
+    Deliver events to the callbacks subscribed to a topic. All
+    callbacks run in the thread of a single event loop, plain
+    callbacks are called right away and coroutine functions
+    are scheduled as tasks on the loop
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+        # Subscribers are kept as tuples so publishing never
+        # copies them and subscribing while publishing is safe
+        self._subscribers: Dict[AnyStr, Tuple[Callable, ...]] = {}
+
+        # Map coroutine functions to the callbacks scheduling them
+        self._wrappers: Dict[Callable, Callable] = {}
+
+        # Events published from other threads wait here until
+        # the loop drains them, waking the loop once per batch
+        self._pending: List[Tuple[AnyStr, Any]] = []
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def subscribe(self, topic: AnyStr, callback: Callable) -> None:
+        """
+        Call callback with every event published to a topic
+        :param topic: Topic name
+        :param callback: Plain callable or coroutine function
+        :return: None
+        """
+
+        if asyncio.iscoroutinefunction(callback):
+            coroutine = callback
+
+            def callback(event, _coroutine=coroutine):
+                self.loop.create_task(_coroutine(event))
+
+            self._wrappers[coroutine] = callback
+
+        self._subscribers[topic] = self._subscribers.get(topic, ()) + (callback,)
+
+    def unsubscribe(self, topic: AnyStr, callback: Callable) -> None:
+        """
+        Stop calling callback with events published to a topic
+        :param topic: Topic name
+        :param callback: A callable given to subscribe
+        :return: None
+        """
+        callback = self._wrappers.pop(callback, callback)
+        self._subscribers[topic] = tuple(
+            subscriber for subscriber in self._subscribers.get(topic, ()) if subscriber != callback
+        )
+
+    def publish(self, topic: AnyStr, event: Any) -> None:
+        """
+        Deliver an event to all subscribers of a topic. Must be
+        called from the event loop thread
+        :param topic: Topic name
+        :param event: Anything the subscribers of topic expect
+        :return: None
+        """
+        for callback in self._subscribers.get(topic, ()):
+            callback(event)
+
+    def publish_threadsafe(self, topic: AnyStr, event: Any) -> None:
+        """
+        Deliver an event from any thread. The subscribers are
+        called later on in the event loop thread. Events that
+        arrive before the loop gets to them share one wake-up
+        :param topic: Topic name
+        :param event: Anything the subscribers of topic expect
+        :return: None
+        """
+        with self._lock:
+            self._pending.append((topic, event))
+
+            if self._scheduled:
+                return None
+
+            self._scheduled = True
+
+        self.loop.call_soon_threadsafe(self._drain)
+
+    def _drain(self) -> None:
+        """ Publish all events handed over by other threads """
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+            self._scheduled = False
+
+        for topic, event in pending:
+            self.publish(topic, event)
+
+
+__all__ = [
+    'DEVICE_FRAME',
+    'DEVICE_ADDED',
+    'DEVICE_REMOVED',
+    'CLIENT_ADDED',
+    'CLIENT_REMOVED',
+    'SHORTCUT',
+    'FOCUS',
+    'ROUTES',
+
+    'EventBus'
+]
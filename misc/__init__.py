@@ -15,5 +15,7 @@
 
 __all__ = [
     'functions',
+    'recording',
+    'tracing',
     'utils'
 ]
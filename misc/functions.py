@@ -14,7 +14,10 @@
 # Author: Jeffersson Abreu (ctw6av)
 
 from structures.ifaddrs import Ifaddrs, SockAddrIn, SockAddrIn6
-from typing import Dict
+from typing import Dict, List, Optional, Set, Tuple
+from structures.bitset import Bitset
+import constants.globals
+import constants.ecodes
 import constants.input
 import ctypes
 import socket
@@ -71,6 +74,125 @@ def get_handlers_by_devices_name(names: list):
     return handlers
 
 
+def _event_number(name: str) -> int:
+    """
+    Get an event type or code by its name (E.g: EV_MSC) or number
+    :param name: Name or number of the event type or code
+    :return: Integer
+    """
+    name = name.strip()
+
+    if name.isdigit():
+        return int(name)
+
+    value = getattr(constants.ecodes, name.upper(), None)
+
+    if not isinstance(value, int):
+        raise ValueError(f"Unknown event {name}")
+
+    return value
+
+
+def get_event_filters(section) -> Dict[str, Dict[int, Optional[Bitset]]]:
+    """
+    Read the events dropped from each device. Every filter gives
+    a device name (* for all devices) and the events it drops,
+    whole event types or single codes of a type:
+
+        filter0 = * | EV_MSC:MSC_SCAN
+        filter1 = AT Translated Set 2 keyboard | EV_LED, EV_REP
+
+    :param section: Filters section read with configparser
+    :return: Dict of dropped codes by event type (None for the
+             whole type) by device name
+    """
+    filters: Dict[str, Dict[int, Optional[Set[int]]]] = {}
+
+    for key in section:
+        value = section.get(key)
+
+        try:
+            name, events = value.rsplit('|', 1)
+            events = [event.partition(':') for event in events.split(',') if event.strip()]
+            events = [(_event_number(ev_type), _event_number(code) if code else None) for ev_type, _, code in events]
+        except ValueError as error:
+            constants.globals.logger.warning(f"Ignoring filter {key}: {error}")
+            continue
+
+        dropped = filters.setdefault(name.strip(), {})
+
+        for ev_type, code in events:
+            if code is None:
+                dropped[ev_type] = None
+            elif ev_type not in dropped or dropped[ev_type] is not None:
+                dropped.setdefault(ev_type, set()).add(code)
+
+    return {
+        name: {ev_type: None if codes is None else Bitset.from_bits(codes) for ev_type, codes in dropped.items()}
+        for name, dropped in filters.items()
+    }
+
+
+def get_screen_layout(section) -> List[Tuple[str, int, int, int, int]]:
+    """
+    Read the screens laid out in a grid. Every screen gives its
+    host (server or the client address), its column and row in
+    the grid and its resolution:
+
+        screen0 = server | 0, 0 | 1920x1080
+        screen1 = 192.168.0.20 | 1, 0 | 2560x1440
+
+    :param section: Layout section read with configparser
+    :return: List of (host, column, row, width, height)
+    """
+    screens = []
+
+    for key in section:
+        value = section.get(key)
+
+        try:
+            host, place, resolution = value.split('|')
+            column, row = (int(number) for number in place.split(','))
+            width, height = (int(number) for number in resolution.lower().split('x'))
+        except ValueError as error:
+            constants.globals.logger.warning(f"Ignoring screen {key}: {error}")
+            continue
+
+        if width <= 0 or height <= 0:
+            constants.globals.logger.warning(f"Ignoring screen {key}: invalid resolution")
+            continue
+
+        screens.append((host.strip(), column, row, width, height))
+
+    return screens
+
+
+def get_device_routes(section) -> Dict[str, str]:
+    """
+    Read the host every routed device is sent to. Devices are
+    given by name or by vendor:product in hex and hosts are
+    server (kept local) or the client address:
+
+        route0 = AT Translated Set 2 keyboard | 192.168.0.20
+        route1 = 046d:c52b | 192.168.0.21
+
+    :param section: Routes section read with configparser
+    :return: Dict of hosts by device name or vendor:product
+    """
+    routes = {}
+
+    for key in section:
+        device, separator, host = section.get(key).rpartition('|')
+
+        if not separator or not device.strip() or not host.strip():
+            constants.globals.logger.warning(f"Ignoring route {key}")
+            continue
+
+        routes[device.strip()] = host.strip()
+
+    return routes
+
+
 def get_network_interfaces() -> dict:
     """
     Get all network interfaces in the system
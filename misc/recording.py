@@ -0,0 +1,219 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.
+#
+# Author: Jeffersson Abreu (ctw6av)
+
+"""
+Record device frames to a file and replay them later
+
+A recording starts with a small header followed by records appended
+one after another. Every record has a fixed size head holding its
+kind, the index of the device, the length of the payload and the
+nanoseconds elapsed since the recording started:
+
+    header  MAGIC VERSION
+    record  KIND INDEX LENGTH ELAPSED PAYLOAD
+    ...
+
+DEVICE records hold the pickled device info sent to clients and are
+written before the frames of their device. Indexes are not reused
+while the server runs, so every DEVICE record is a different device
+even when devices were unplugged while recording. FRAME records hold
+the packed events of a frame exactly as read from the device. A
+recording cut short (E.g: the server was killed) is still readable up to its
+last full record.
+"""
+
+from events.bus import EventBus, DEVICE_FRAME, DEVICE_ADDED
+from typing import Iterator, List, Tuple
+from structures.frame import Frame
+import constants.globals
+import misc.tracing
+import asyncio
+import pickle
+import struct
+import mmap
+import time
+
+
+MAGIC = b'STRINREC'
+VERSION = 2
+
+# Magic and version of the recording format
+HEADER = struct.Struct('!8sH')
+
+# Kind, device index, payload length and elapsed nanoseconds. The
+# index is as wide as the one in the header of network messages
+RECORD = struct.Struct('!BHIQ')
+
+# Kinds of records
+DEVICE = 1
+FRAME = 2
+
+# Frames replayed between two event loop iterations at full speed
+PLAY_BATCH = 64
+
+
+class Recorder(object):
+    """ Append every frame published in the bus to a recording """
+
+    def __init__(self, path: str, bus: EventBus, devices_info: List[dict]):
+        self.path = path
+        self.bus = bus
+        self.file = open(path, 'wb')
+        self.start = time.monotonic_ns()
+        self.frames = 0
+
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+
+        for info in devices_info:
+            self._append(DEVICE, info['index'], pickle.dumps(info), self.start)
+
+        constants.globals.logger.info(f"Recording frames to {path}")
+        bus.subscribe(DEVICE_FRAME, self.record)
+        bus.subscribe(DEVICE_ADDED, self.plugged)
+
+    def _append(self, kind: int, index: int, payload: bytes, stamp: int) -> None:
+        self.file.write(RECORD.pack(kind, index, len(payload), stamp - self.start))
+        self.file.write(payload)
+
+    def plugged(self, device) -> None:
+        """ Append the information of a device plugged while recording """
+        self._append(DEVICE, device.index, pickle.dumps(device.info), time.monotonic_ns())
+
+    def record(self, frame: Frame) -> None:
+        """ Append a frame read from a device """
+        self._append(FRAME, frame.index, frame.raw, frame.stamp or time.monotonic_ns())
+        self.frames += 1
+
+    def close(self) -> None:
+        """ Write what is left in the buffers and close the file """
+        if not self.file.closed:
+            self.bus.unsubscribe(DEVICE_FRAME, self.record)
+            self.bus.unsubscribe(DEVICE_ADDED, self.plugged)
+            self.file.close()
+            constants.globals.logger.info(f"Recorded {self.frames} frames to {self.path}")
+
+
+class Recording(object):
+    """
+    Memory mapped recording. Records are read straight from the
+    page cache, so opening even a large recording is cheap
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < HEADER.size:
+            raise ValueError(f"{path} is not a Strino recording")
+
+        magic, version = HEADER.unpack_from(self._map)
+
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a Strino recording")
+
+        if version != VERSION:
+            raise ValueError(f"{path} was recorded with an unsupported version ({version})")
+
+        # Device info of every recorded device
+        self.devices: List[dict] = [
+            pickle.loads(payload) for kind, _, _, payload in self.records() if kind == DEVICE
+        ]
+
+    def records(self) -> Iterator[Tuple[int, int, int, bytes]]:
+        """
+        Iterate over every full record of the recording
+        :return: Iterator of (kind, index, elapsed, payload)
+        """
+        data = self._map
+        size = len(data)
+        offset = HEADER.size
+
+        while offset + RECORD.size <= size:
+            kind, index, length, elapsed = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+
+            if offset + length > size:
+                # The recording was cut in the middle of a record
+                break
+
+            yield kind, index, elapsed, data[offset:offset + length]
+            offset += length
+
+    def frames(self) -> Iterator[Tuple[int, Frame]]:
+        """
+        Iterate over the recorded frames
+        :return: Iterator of (elapsed, frame)
+        """
+        for kind, index, elapsed, payload in self.records():
+            if kind == FRAME:
+                yield elapsed, Frame(index, payload)
+
+    def close(self) -> None:
+        self._map.close()
+
+
+class Player(object):
+    """ Publish the frames of a recording in the bus """
+
+    def __init__(self, recording: Recording, bus: EventBus, speed: float = 1.0):
+        self.recording = recording
+        self.bus = bus
+
+        # Times faster than recorded, as fast as possible when 0
+        self.speed = speed
+        self._task = None
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """ Start playing unless it is already playing """
+        if self._task is None:
+            self._task = loop.create_task(self.play())
+
+    async def play(self) -> None:
+        """ Publish every recorded frame at the recorded pace """
+        constants.globals.logger.info(f"Replaying {self.recording.path}")
+
+        publish = self.bus.publish
+        speed = self.speed
+        start = time.monotonic_ns()
+        played = 0
+
+        for elapsed, frame in self.recording.frames():
+            if speed:
+                # Keep the pace without drifting
+                delay = start + elapsed / speed - time.monotonic_ns()
+
+                if delay > 0:
+                    await asyncio.sleep(delay / 1e9)
+
+            elif not played % PLAY_BATCH:
+                # Let the writers flush as a device read would
+                await asyncio.sleep(0)
+
+            if misc.tracing.tracer is not None:
+                frame.stamp = time.monotonic_ns()
+
+            publish(DEVICE_FRAME, frame)
+            played += 1
+
+        constants.globals.logger.info(f"Replayed {played} frames from {self.recording.path}")
+
+
+__all__ = [
+    'Recorder',
+    'Recording',
+    'Player'
+]
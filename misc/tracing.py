@@ -0,0 +1,136 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.
+#
+# Author: Jeffersson Abreu (ctw6av)
+
+from typing import Dict, List, Optional
+import constants.globals
+import time
+
+
+# Stages a frame goes through, in order. Server side stages are
+# measured from the moment the frame is read from the device and
+# client side stages from the moment the frame is received
+SERVER_STAGES = ['dispatch', 'encode', 'write', 'switch']
+CLIENT_STAGES = ['decode', 'emit']
+
+# Buckets of a histogram, one per power of two nanoseconds
+BUCKETS = 48
+
+
+class Histogram(object):
+    """
+    Latency histogram with power of two buckets. Recording a
+    sample is an integer bit_length and a list increment
+    """
+
+    __slots__ = ('buckets', 'count', 'total', 'maximum')
+
+    def __init__(self):
+        self.buckets: List[int] = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+    def record(self, elapsed: int) -> None:
+        """
+        Add a sample to the histogram
+        :param elapsed: Latency in nanoseconds
+        :return: None
+        """
+        self.buckets[min(elapsed.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += elapsed
+
+        if elapsed > self.maximum:
+            self.maximum = elapsed
+
+    def percentile(self, percent: float) -> int:
+        """
+        Get an upper bound of a latency percentile
+        :param percent: Percentile wanted (E.g: 99.9)
+        :return: Latency in nanoseconds
+        """
+        wanted = self.count * percent / 100
+        seen = 0
+
+        for bucket, samples in enumerate(self.buckets):
+            seen += samples
+            if samples and seen >= wanted:
+                return min(1 << bucket, self.maximum)
+
+        return self.maximum
+
+
+class Tracer(object):
+    """ Keep a latency histogram for every stage of the pipeline """
+
+    def __init__(self, stages: List[str]):
+        self.histograms: Dict[str, Histogram] = {stage: Histogram() for stage in stages}
+
+        # When the data being digested was received
+        self.received = 0
+
+    def record(self, stage: str, start: int) -> None:
+        """
+        Record how long it took to reach a stage
+        :param stage: Stage name
+        :param start: Value of time.monotonic_ns when the frame started
+        :return: None
+        """
+        self.histograms[stage].record(time.monotonic_ns() - start)
+
+    def dump(self) -> str:
+        """ Format all histograms as a table in microseconds """
+        lines = [f"{'Stage':<10} {'Count':>10} {'Mean':>10} {'p50':>10} {'p99':>10} {'p999':>10} {'Max':>10}"]
+
+        for stage, histogram in self.histograms.items():
+            mean = histogram.total // histogram.count if histogram.count else 0
+            lines.append(
+                f"{stage:<10} {histogram.count:>10} {mean / 1000:>10.1f} "
+                f"{histogram.percentile(50) / 1000:>10.1f} {histogram.percentile(99) / 1000:>10.1f} "
+                f"{histogram.percentile(99.9) / 1000:>10.1f} {histogram.maximum / 1000:>10.1f}"
+            )
+
+        return '\n'.join(lines)
+
+    def log(self) -> None:
+        """ Write all histograms to the log """
+        constants.globals.logger.info('Latency per stage (us)')
+        for line in self.dump().split('\n'):
+            constants.globals.logger.info(line)
+
+
+# The tracer in use, tracing is off while it is None
+tracer: Optional[Tracer] = None
+
+
+def enable(stages: List[str]) -> Tracer:
+    """
+    Start recording latencies of the given stages
+    :param stages: SERVER_STAGES or CLIENT_STAGES
+    :return: The tracer in use
+    """
+    global tracer
+    tracer = Tracer(stages)
+    constants.globals.logger.info('Latency tracing is enabled')
+    return tracer
+
+
+__all__ = [
+    'SERVER_STAGES',
+    'CLIENT_STAGES',
+    'Histogram',
+    'Tracer',
+    'enable'
+]
@@ -14,13 +14,35 @@
 # Author: Jeffersson Abreu (ctw6av)
 
 
+from structures.frame import Frame, is_motion, coalesce
 from networking.handlers import *
 import constants.globals
+import misc.tracing
 import asyncio
-import pickle
+import time
 import sys
 
 
+# Amount of bytes buffered in a client transport before it is
+# paused. That is around 150 frames of a mouse moving on two axes
+WRITE_BUFFER_HIGH = 8 * 1024
+
+# Frames queued for a paused client before its motion frames
+# are dropped. Key and button frames are always queued, so no
+# key is left held down on the client
+QUEUE_LIMIT = 512
+
+# Frames queued for a paused client that is then too far behind
+# to catch up. It is disconnected and releases its keys when it
+# connects again
+QUEUE_ABORT = 8 * QUEUE_LIMIT
+
+# What a paused client does with motion frames piling up. They
+# are summed into the last one queued (coalesce) or, once the
+# queue is full, dropped (drop)
+WRITE_POLICIES = ['coalesce', 'drop']
+
+
 class Events(object):
     """ Represents a system event """
     def __init__(self):
@@ -29,43 +51,130 @@ class Events(object):
         # callback function to keep a nice communication
         self._events = {
             "CREATE_DEVICE": {
+                "type": CREATE_DEVICE,
                 "generate": generate_create_device,
                 "digest": digest_create_device
             },
 
             "DEVICE_EVENT": {
+                "type": DEVICE_EVENT,
                 "generate": generate_device_event,
                 "digest": digest_device_event
+            },
+
+            "ADD_DEVICE": {
+                "type": ADD_DEVICE,
+                "generate": generate_add_device,
+                "digest": digest_add_device
+            },
+
+            "REMOVE_DEVICE": {
+                "type": REMOVE_DEVICE,
+                "generate": generate_remove_device,
+                "digest": digest_remove_device
             }
         }
 
-    def handle(self, data: bytes, protocol: asyncio.Protocol):
+        # Map the message types found in frame
+        # headers back to their digest callbacks
+        self._digests = {
+            event.get("type"): event.get("digest") for event in self._events.values()
+        }
+
+        # Keeps partial frames between calls to handle
+        self._buffer = bytearray()
+
+    def handle(self, data: bytes, protocol: asyncio.Protocol = None):
         """
-        Handle an event in hole application
+        Handle an event in hole application. The stream may
+        carry several frames in a single chunk or split one
+        frame across chunks, so incomplete frames are kept in
+        a receive buffer until the rest of them arrives
         :param protocol: asyncio.Protocol instance
         :param data: Binary event
-        :return: None
+        :return: False when the stream is corrupt and the connection was closed
         """
 
-        try:
-            event = pickle.loads(data)
-            event_name = event.get("name")
-            event_data = event.get("data")
-        except Exception as exc:
-            constants.globals.logger.warning("Error receiving event")
-            constants.globals.logger.warning(exc)
+        buffer = self._buffer
+        tracer = misc.tracing.tracer
+
+        if tracer is not None:
+            tracer.received = time.monotonic_ns()
+
+        # Only copy into the receive buffer when there is a
+        # partial frame waiting, otherwise frames are sliced
+        # straight out of the chunk received
+        if buffer:
+            buffer += data
+            data = buffer
+
+        offset = self._consume(data, protocol)
+
+        if offset < 0:
+            # The stream can not be trusted anymore, nothing after
+            # a bad header can be framed so the connection is dropped
+            buffer.clear()
+
+            if protocol is not None:
+                protocol.transport.close()
+
             return False
 
-        # Check if the received event is listed as valid
-        if self.is_valid(event_name):
+        if data is buffer:
+            del buffer[:offset]
+        elif offset < len(data):
+            buffer += memoryview(data)[offset:]
+
+    def _consume(self, data, protocol: asyncio.Protocol) -> int:
+        """
+        Digest every complete frame in data
+        :param data: Bytes-like object starting at a frame header
+        :param protocol: asyncio.Protocol instance
+        :return: How many bytes were consumed or -1 on error
+        """
+
+        view = memoryview(data)
+        size = len(view)
+        offset = 0
+
+        try:
+            while size - offset >= HEADER_SIZE:
+                version, kind, index, length = decode_header(view, offset)
+
+                if version != PROTOCOL_VERSION:
+                    constants.globals.logger.warning("Error receiving event")
+                    constants.globals.logger.warning(f"Unsupported protocol version {version}")
+                    return -1
+
+                if length > MAX_PAYLOAD:
+                    constants.globals.logger.warning("Error receiving event")
+                    constants.globals.logger.warning(f"Payload of {length} bytes is too long")
+                    return -1
+
+                start = offset + HEADER_SIZE
+                end = start + length
+
+                # Wait for the rest of the frame
+                if end > size:
+                    break
+
+                # Get the digest callback of the received message type
+                callback = self._digests.get(kind)
+
+                if callback is not None:
+                    # The payload is a view on the receive buffer
+                    # so it is only valid during the callback
+                    payload = view[start:end]
+                    try:
+                        callback(index, payload, protocol)
+                    finally:
+                        payload.release()
 
-            # Get all event callbacks and choose the digest one
-            event_callables = self._events.get(event_name)
-            callback = event_callables.get("digest")
+                offset = end
+        finally:
+            view.release()
 
-            # Call a digest callback with
-            # binary event data received
-            callback(event_data, protocol)
+        return offset
 
     def generate(self, event_name: str, *args, **kwargs):
         """
@@ -74,15 +183,13 @@ class Events(object):
         :return: Return encoded data except on error that will return None
         """
 
-        if self.is_valid(event_name):
-
-            # Get all event callbacks and choose the generate
-            event_callables = self._events.get(event_name)
-            callback = event_callables.get("generate")
+        # Get all event callbacks and choose the generate
+        event_callables = self._events.get(event_name)
 
+        if event_callables is not None:
             # Generate callback
-            event = callback(*args, **kwargs)
-            return event
+            callback = event_callables.get("generate")
+            return callback(*args, **kwargs)
 
         constants.globals.logger.critical(f"Event {event_name} is not recognized")
         constants.globals.logger.info(f"Exiting now")
@@ -100,6 +207,126 @@ class Events(object):
         return False
 
 
+class FrameWriter(object):
+    """
+    Hand frames to a transport. Frames written during the same
+    event loop iteration are sent with a single writelines call
+    on the next iteration. While the transport is paused because
+    the client can not keep up, queued motion frames are summed
+    into one instead of piling up and the queue is bounded, so a
+    slow client never holds back the others. Encoded frames are
+    never changed, the same bytes may be queued by many writers.
+    Must only be used from the loop thread
+    """
+
+    def __init__(self, transport: asyncio.WriteTransport, loop: asyncio.AbstractEventLoop = None,
+                 limit: int = QUEUE_LIMIT, policy: str = 'coalesce'):
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.transport = transport
+
+        if policy not in WRITE_POLICIES:
+            raise ValueError(f"Unknown write policy {policy}")
+
+        # Motion frames queued while paused, see WRITE_POLICIES
+        self.limit = limit
+        self.coalescing = policy == 'coalesce'
+
+        # Motion frames dropped since the client was paused
+        self.dropped = 0
+
+        # Set by the protocol when the transport buffer goes over its
+        # high water mark, WRITE_BUFFER_HIGH for client connections
+        self.paused = False
+
+        # Frames waiting for the next flush, along with the
+        # device frame each of them encodes (None otherwise)
+        self._frames = []
+        self._sources = []
+
+    def write(self, data: bytes, frame: Frame = None) -> None:
+        """
+        Queue a frame to be sent
+        :param data: Encoded frame
+        :param frame: Device frame encoded in data, if any
+        :return: None
+        """
+        frames = self._frames
+        sources = self._sources
+
+        if self.paused and frame is not None and sources:
+            last = sources[-1]
+            motion = is_motion(frame)
+
+            # Only motion right after motion of the same device is
+            # merged, so keys and buttons keep their exact order
+            if self.coalescing and motion and last is not None and last.index == frame.index and is_motion(last):
+                merged = coalesce(last, frame)
+                frames[-1] = generate_device_event(merged)
+                sources[-1] = merged
+                return None
+
+            if len(frames) >= self.limit:
+                if motion:
+                    self.dropped += 1
+                    return None
+
+                if len(frames) >= QUEUE_ABORT:
+                    constants.globals.logger.warning("Disconnecting a client too far behind")
+                    self._frames = []
+                    self._sources = []
+                    self.transport.abort()
+                    return None
+
+        frames.append(data)
+        sources.append(frame)
+
+        # Only the first frame of a batch schedules the flush
+        if len(frames) == 1:
+            self.loop.call_soon(self.flush)
+
+    def flush(self) -> None:
+        """ Send all queued frames at once """
+        frames = self._frames
+
+        # Frames are kept until the transport resumes
+        if not frames or self.paused:
+            return None
+
+        sources = self._sources
+        self._frames = []
+        self._sources = []
+
+        if not self.transport.is_closing():
+            self.transport.writelines(frames)
+
+        tracer = misc.tracing.tracer
+
+        if tracer is not None:
+            for source in sources:
+                if source is not None:
+                    tracer.record('write', source.stamp)
+
+    def pause(self) -> None:
+        """ Stop writing, the transport buffer is full """
+        self.paused = True
+
+    def resume(self) -> None:
+        """ Write everything queued while we were paused """
+        self.paused = False
+
+        if self.dropped:
+            constants.globals.logger.debug(f"Dropped {self.dropped} motion frames of a slow client")
+            self.dropped = 0
+
+        self.flush()
+
+
 __all__ = [
+    'WRITE_BUFFER_HIGH',
+    'QUEUE_LIMIT',
+    'QUEUE_ABORT',
+    'WRITE_POLICIES',
+
+    'FrameWriter',
     'Events'
 ]
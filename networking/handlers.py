@@ -13,70 +13,195 @@
 #
 # Author: Jeffersson Abreu (ctw6av)
 
-import devices.virtual
+import misc.tracing
 import pickle
+import struct
+
+
+# Version of the binary wire protocol. Both sides refuse
+# frames with a different version instead of guessing
+PROTOCOL_VERSION = 1
+
+# Every message starts with a fixed header holding the protocol
+# version, the message type, the device index (as assigned at
+# CREATE_DEVICE time) and the length of the payload that follows
+HEADER = struct.Struct('!BBHI')
+HEADER_SIZE = HEADER.size
+
+# Longest payload accepted. Anything longer is a corrupt header,
+# buffering it would make the receive buffer grow without bound
+MAX_PAYLOAD = 1024 * 1024
+
+# Message types
+CREATE_DEVICE = 0x01
+DEVICE_EVENT = 0x02
+ADD_DEVICE = 0x03
+REMOVE_DEVICE = 0x04
+
+
+def encode_frame(kind: int, index: int, payload: bytes) -> bytes:
+    """
+    Pack a message into the wire format
+    :param kind: Message type
+    :param index: Device index the message refers to
+    :param payload: Message payload
+    :return: Header followed by the payload
+    """
+    return HEADER.pack(PROTOCOL_VERSION, kind, index, len(payload)) + payload
+
+
+def decode_header(buffer, offset: int = 0) -> tuple:
+    """
+    Unpack a message header from any bytes-like object
+    :param buffer: Bytes-like object holding at least a header
+    :param offset: Where the header starts in buffer
+    :return: Tuple (version, kind, index, length)
+    """
+    return HEADER.unpack_from(buffer, offset)
 
 
 def generate_create_device(info) -> bytes:
     """
-    Generate a "create device" event
+    Generate a "create device" event. Devices are announced
+    once per connection so the payload keeps being pickled
     :return: Encoded and packed data
     """
 
-    return pickle.dumps({
-        "name": "CREATE_DEVICE",
-        "data": info
-    })
+    return encode_frame(CREATE_DEVICE, 0, pickle.dumps(info))
 
 
-def digest_create_device(info, protocol):
+def digest_create_device(index, payload, protocol):
     """
     Handle all clients announcements
+    :param index: Not used by this message
+    :param payload: Pickled list of devices information
     :param protocol: asyncio.Protocol instance
-    :param info: event information
     :return: None
     """
-    virtual_devices = {}
-    for devinfo in info:
-        device = devices.virtual.VirtualDevice(devinfo)
-        virtual_devices[device.name] = device
+    pool = protocol.pool
 
+    # Devices are taken from the pool, so the ones a lost
+    # connection left behind are reused when they match
+    for device in protocol.devices.values():
+        pool.release(device)
+
+    virtual_devices = {}
     setattr(protocol, 'devices', virtual_devices)
+
+    for devinfo in pickle.loads(payload):
+        pool.attach(virtual_devices, devinfo.get('index'), devinfo)
+
+    pool.sweep()
+    return None
+
+
+def generate_add_device(info) -> bytes:
+    """
+    Generate an "add device" event announcing a single
+    device plugged after the connection was made
+    :param info: Device information
+    :return: Encoded and packed data
+    """
+    return encode_frame(ADD_DEVICE, info['index'], pickle.dumps(info))
+
+
+def digest_add_device(index, payload, protocol):
+    """
+    Create the virtual device of a device plugged in the server
+    :param index: Index of the device plugged
+    :param payload: Pickled device information
+    :param protocol: asyncio.Protocol instance
+    :return: None
+    """
+    pool = protocol.pool
+
+    # A device missed while unplugged is replaced
+    previous = protocol.devices.get(index)
+    if previous is not None:
+        pool.release(previous)
+
+    pool.attach(protocol.devices, index, pickle.loads(payload))
+    pool.sweep()
     return None
 
 
-def generate_device_event(data):
+def generate_remove_device(info) -> bytes:
     """
-    Generate an device event type and encode data
+    Generate a "remove device" event, only the index is sent
+    :param info: Device information
     :return: Encoded and packed data
     """
+    return encode_frame(REMOVE_DEVICE, info['index'], b'')
+
 
-    return pickle.dumps({
-        "name": "DEVICE_EVENT",
-        "data": data
-    })
+def digest_remove_device(index, payload, protocol):
+    """
+    Destroy the virtual device of a device unplugged in the server
+    :param index: Index of the device unplugged
+    :param payload: Not used by this message
+    :param protocol: asyncio.Protocol instance
+    :return: None
+    """
+    device = protocol.devices.pop(index, None)
+    if device is not None:
+        protocol.pool.destroy(device)
+    return None
 
 
-def digest_device_event(data, protocol):
+def generate_device_event(frame) -> bytes:
+    """
+    Generate an device event type and encode data. The
+    payload is just the packed input_event structures
+    :param frame: structures.frame.Frame instance
+    :return: Encoded and packed data
     """
-     Digest device events received from server
-    :param data: Dictionary data
+    return encode_frame(DEVICE_EVENT, frame.index, frame.raw)
+
+
+def digest_device_event(index, payload, protocol):
+    """
+    Digest device events received from server
+    :param index: Index of the device that produced the events
+    :param payload: Packed input_event structures
     :param protocol: asyncio.Protocol instance
     :return: None
     """
-    name = data.get('name')
-    device = protocol.devices.get(name)
+    device = protocol.devices.get(index)
     if device is not None:
-        device.emit(data.get('data'))
+        tracer = misc.tracing.tracer
+
+        if tracer is None:
+            device.emit(payload)
+            return None
+
+        tracer.record('decode', tracer.received)
+        device.emit(payload)
+        tracer.record('emit', tracer.received)
 
 
 __all__ = [
+    'PROTOCOL_VERSION',
+    'HEADER_SIZE',
+    'HEADER',
+    'MAX_PAYLOAD',
+
+    'CREATE_DEVICE',
+    'DEVICE_EVENT',
+    'ADD_DEVICE',
+    'REMOVE_DEVICE',
+
+    'encode_frame',
+    'decode_header',
+
     'generate_device_event',
     'digest_device_event',
 
     'generate_create_device',
-    'generate_create_device',
-    'generate_create_device',
-    'generate_create_device',
-    'digest_create_device'
+    'digest_create_device',
+
+    'generate_add_device',
+    'digest_add_device',
+
+    'generate_remove_device',
+    'digest_remove_device'
 ]
@@ -0,0 +1,200 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.
+#
+# Author: Jeffersson Abreu (ctw6av)
+
+from events.bus import EventBus, DEVICE_FRAME, FOCUS
+from typing import Dict, Iterable, Optional, Tuple
+from structures.frame import Frame
+import server.observers
+import constants.globals
+import constants.ecodes
+
+
+# Looked up for every event of every frame
+EV_REL = constants.ecodes.EV_REL
+REL_X = constants.ecodes.REL_X
+REL_Y = constants.ecodes.REL_Y
+
+
+class Screen(object):
+    """ Screen of a host placed in a grid of screens """
+
+    __slots__ = ('host', 'column', 'row', 'width', 'height')
+
+    def __init__(self, host: str, column: int, row: int, width: int, height: int):
+
+        # Address of the client or server.observers.SERVER_HOST
+        self.host = host
+
+        # Place in the grid, columns grow to the right and rows down
+        self.column = column
+        self.row = row
+
+        # Resolution in pixels
+        self.width = width
+        self.height = height
+
+    def __repr__(self) -> str:
+        return f"Screen({self.host!r}, {self.column}, {self.row}, {self.width}x{self.height})"
+
+
+class ScreenLayout(object):
+    """ Grid of the screens sharing devices """
+
+    def __init__(self, screens: Iterable[Tuple[str, int, int, int, int]]):
+        self.hosts: Dict[str, Screen] = {}
+        self._grid: Dict[Tuple[int, int], Screen] = {}
+
+        for host, column, row, width, height in screens:
+            screen = Screen(host, column, row, width, height)
+            self.hosts[host] = screen
+            self._grid[(column, row)] = screen
+
+    def __bool__(self) -> bool:
+        return bool(self.hosts)
+
+    def neighbour(self, screen: Screen, columns: int, rows: int) -> Optional[Screen]:
+        """
+        Get the screen placed next to another
+        :param screen: Screen instance
+        :param columns: Columns away from screen (-1 is the left one)
+        :param rows: Rows away from screen (-1 is the one above)
+        :return: Screen instance or None
+        """
+        return self._grid.get((screen.column + columns, screen.row + rows))
+
+
+class PointerTracker(object):
+    """
+    Follow the mouse pointer over the screen layout with a virtual
+    cursor moved by relative motion. The focus moves to the screen
+    next to the edge the cursor crosses. Must subscribe before the
+    EventSender, so the frame crossing the edge is sent to the host
+    getting the focus
+    """
+
+    def __init__(self, bus: EventBus, focus: server.observers.FocusEvents, layout: ScreenLayout,
+                 routes: Optional[Dict[int, server.observers.ClientHandle]] = None):
+        self.bus = bus
+        self.focus = focus
+        self.layout = layout
+
+        # Routed devices do not follow the focus nor move the pointer
+        self._routes = routes if routes is not None else {}
+
+        # Screen in focus, cursor is not tracked while None
+        self.screen = layout.hosts.get(server.observers.SERVER_HOST)
+
+        # Virtual cursor position in the screen in focus
+        self.x = 0
+        self.y = 0
+        self._center()
+
+        bus.subscribe(DEVICE_FRAME, self.track)
+        bus.subscribe(FOCUS, self.follow)
+
+    def _center(self) -> None:
+        """ Place the cursor at the center of the screen in focus """
+        if self.screen is not None:
+            self.x = self.screen.width // 2
+            self.y = self.screen.height // 2
+
+    def follow(self, client: server.observers.ClientHandle) -> None:
+        """ Keep the screen in focus when something else moves the focus """
+        host = client.host
+
+        if self.screen is not None and self.screen.host == host:
+            return None
+
+        self.screen = self.layout.hosts.get(host)
+        self._center()
+
+    def track(self, frame: Frame) -> None:
+        """ Move the cursor by the relative motion of a frame """
+        screen = self.screen
+
+        if screen is None or frame.index in self._routes:
+            return None
+
+        events = frame.events
+        x = self.x
+        y = self.y
+
+        # Walk the flat decoded events, nothing is built per event
+        for position in range(0, len(events), 3):
+            if events[position] != EV_REL:
+                continue
+
+            code = events[position + 1]
+
+            if code == REL_X:
+                x += events[position + 2]
+            elif code == REL_Y:
+                y += events[position + 2]
+
+        if 0 <= x < screen.width and 0 <= y < screen.height:
+            self.x = x
+            self.y = y
+            return None
+
+        self._cross(screen, x, y)
+
+    def _cross(self, screen: Screen, x: int, y: int) -> None:
+        """
+        Move the focus to the screen next to the edge crossed,
+        or keep the cursor inside the screen when there is none
+        :param screen: Screen in focus
+        :param x: Cursor position out of screen
+        :param y: Cursor position out of screen
+        :return: None
+        """
+        columns = -1 if x < 0 else 1 if x >= screen.width else 0
+        rows = -1 if y < 0 else 1 if y >= screen.height else 0
+
+        neighbour = self.layout.neighbour(screen, columns, 0) if columns else None
+        client = self.focus.client(neighbour.host) if neighbour is not None else None
+
+        if client is None and rows:
+            columns = 0
+            neighbour = self.layout.neighbour(screen, 0, rows)
+            client = self.focus.client(neighbour.host) if neighbour is not None else None
+
+        if client is None:
+            # Nobody there, the cursor stops at the edge
+            self.x = min(max(x, 0), screen.width - 1)
+            self.y = min(max(y, 0), screen.height - 1)
+            return None
+
+        # Enter the neighbour by the opposite edge keeping the
+        # relative position along the edge crossed
+        if columns:
+            self.x = x + neighbour.width if columns < 0 else x - screen.width
+            self.y = min(max(y, 0), screen.height - 1) * neighbour.height // screen.height
+        else:
+            self.x = min(max(x, 0), screen.width - 1) * neighbour.width // screen.width
+            self.y = y + neighbour.height if rows < 0 else y - screen.height
+
+        self.x = min(max(self.x, 0), neighbour.width - 1)
+        self.y = min(max(self.y, 0), neighbour.height - 1)
+        self.screen = neighbour
+
+        constants.globals.logger.debug(f"Pointer crossed to {neighbour}")
+        self.focus.focus_on(client)
+
+
+__all__ = [
+    'Screen',
+    'ScreenLayout',
+    'PointerTracker'
+]
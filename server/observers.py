@@ -13,56 +13,140 @@
 #
 # Author: Jeffersson Abreu (ctw6av)
 
-from structures.input import InputEvent
-from events.interfaces import Observer
-from typing import AnyStr, Dict, List
+from structures.frame import Frame
+from events.bus import EventBus, DEVICE_FRAME, DEVICE_ADDED, DEVICE_REMOVED, CLIENT_ADDED, CLIENT_REMOVED
+from events.bus import SHORTCUT, FOCUS, ROUTES
+from typing import AnyStr, Dict, List, Optional, Tuple
 import networking.communication
 import constants.globals
 import devices.physical
 import constants.ecodes
+import misc.tracing
 import configparser
-import asyncio
+import time
 import os
 
 
-class EventSender(Observer):
+# Host of the server itself, clients are known by their address
+SERVER_HOST = 'server'
+
+
+class ClientHandle(object):
+    """
+    A client in the focus ring. Handles are linked in a ring
+    starting at the server, ordered by the first time their
+    host connected, so reconnecting keeps the place of a host
+    """
+
+    __slots__ = ('identification', 'writer', 'host', 'rank', 'previous', 'next')
+
+    def __init__(self, identification: AnyStr, writer: Optional[networking.communication.FrameWriter],
+                 host: Optional[str] = None, rank: int = 0):
+        self.identification = identification
+
+        # Frames are never written while the server is in focus
+        self.writer = writer
+        self.host = host
+
+        # Place in the ring
+        self.rank = rank
+
+        # Neighbours in the ring, a lone handle is its own neighbour
+        self.previous: ClientHandle = self
+        self.next: ClientHandle = self
+
+    def __repr__(self) -> str:
+        return f"ClientHandle({self.identification!r}, {self.host!r})"
+
+
+class EventSender(object):
     """
     Send all events that occurs to the
-    client in focus at the moment.
+    client in focus at the moment, or to
+    the client their device is routed to.
+    In broadcast mode they are sent to
+    every client at once
     """
 
-    def __init__(self, *args, **kwargs):
-        Observer.__init__(self, *args, **kwargs)
+    def __init__(self, bus: EventBus, routes: Optional[Dict[int, ClientHandle]] = None, broadcast: bool = False):
 
         # Networking events handler
         self.events = networking.communication.Events()
 
-        self._identification = None
-        self._transport = None
+        # Clients of the routed devices by index, kept by a Router
+        self._routes = routes if routes is not None else {}
+
+        self._writer = None
+
+        # Writers of every client, frames not routed go to all of
+        # them while broadcasting instead of the client in focus
+        self.broadcast = broadcast
+        self._writers: Tuple[networking.communication.FrameWriter, ...] = ()
+
+        bus.subscribe(DEVICE_FRAME, self.send)
+        bus.subscribe(FOCUS, self.change_focus)
+
+        if broadcast:
+            bus.subscribe(CLIENT_ADDED, self.connected)
+            bus.subscribe(CLIENT_REMOVED, self.disconnected)
+
+    def _encode(self, frame: Frame) -> bytes:
+        """ Encode a device frame once, whoever it is sent to """
+        tracer = misc.tracing.tracer
+
+        if tracer is not None:
+            tracer.record('dispatch', frame.stamp)
+
+        evt = self.events.generate("DEVICE_EVENT", frame)
+
+        if tracer is not None:
+            tracer.record('encode', frame.stamp)
+
+        return evt
+
+    def send(self, frame: Frame) -> None:
+        """ Send a device frame to the client in focus """
+        client = self._routes.get(frame.index)
+
+        if client is None and self.broadcast:
+            writers = self._writers
+
+            if writers:
+                # Every client queues the very same bytes, a slow
+                # one only merges or drops frames in its own queue
+                evt = self._encode(frame)
+
+                for writer in writers:
+                    writer.write(evt, frame)
+
+            return None
+
+        writer = self._writer if client is None else client.writer
+
+        if writer is not None:
+            writer.write(self._encode(frame), frame)
 
-    def run(self) -> None:
-        while True:
-            data = self.queue.get()
-            who, event = data.values()
+    def change_focus(self, client: ClientHandle) -> None:
+        """ Keep the frame writer of the client in focus """
+        self._writer = client.writer
 
-            if who == 'PhysicalDevice':
-                if self._identification is not 'StrinoServer' and self._identification is not None:
-                    evt = self.events.generate("DEVICE_EVENT", event)
-                    self._transport.write(evt)
+    def connected(self, client: ClientHandle) -> None:
+        """ Broadcast frames to a new client """
+        self._writers += (client.writer,)
 
-            if who == 'FocusEvents':
-                self._identification = event.get('identification')
-                self._transport = event.get('transport')
+    def disconnected(self, client: ClientHandle) -> None:
+        """ Stop broadcasting frames to a client gone """
+        self._writers = tuple(writer for writer in self._writers if writer is not client.writer)
 
 
-class ShortcutListener(Observer):
+class ShortcutListener(object):
     """
     Listen to events and try to match the keyboard
-    shortcuts and notify all observers attached
+    shortcuts and publish the shortcuts matched
     """
 
-    def __init__(self, *args, **kwargs):
-        Observer.__init__(self, *args, **kwargs)
+    def __init__(self, bus: EventBus):
+        self.bus = bus
 
         # Open shortcuts settings and load all of then
         self.path = os.path.join(constants.globals.BASE_DIR, 'etc/shortcuts.ini')
@@ -75,6 +159,8 @@ class ShortcutListener(Observer):
         self.event = None
         self.modifier = 0
 
+        bus.subscribe(DEVICE_FRAME, self.listen)
+
     @staticmethod
     def get_all_modifiers(shortcuts):
         """
@@ -117,151 +203,278 @@ class ShortcutListener(Observer):
                 events[event] = name
         return events
 
-    def run(self) -> None:
-        while True:
-            data = self.queue.get()
-            who, event = data.values()
-
-            if who == "PhysicalDevice":
-                data = event.get('data')
-
-                for evt in data:
-                    ie = InputEvent.from_buffer_copy(evt)
-                    if ie.type == constants.ecodes.EV_KEY:
-                        # In case of the key pressed is an modifier
-                        if ie.code in self.modifiers:
-                            if ie.value:  # Pressing
-                                self.modifier = ie.code
-                                continue
-
-                            # Releasing
-                            self.modifier = 0
-
-                            # We just propagate the shortcut event
-                            # when the modifier key is released to
-                            # prevent bug that stuck devices
-                            if self.event:
-                                event = self.event
-                                self.notify(event)
-                                self.event = None
-                            continue
-
-                        if self.modifier:  # A modifier is pressed
-                            if not ie.value:  # The key is being released
-
-                                # Generate a key name as in "map" function defined above
-                                keys = [str(self.modifier), str(ie.code)]
-                                shortcut = ' '.join(keys)
-
-                                # Check if shortcut name is in
-                                # mapped shortcuts list
-                                if shortcut in self.shortcuts:
-                                    # Set the shortcut event to be sent on modifier key release
-                                    self.event = {'name': self.shortcuts[shortcut]}
-
-
-class FocusEvents(Observer):
+    def listen(self, frame: Frame) -> None:
+        """ Look for shortcuts in a device frame """
+        for ev_type, code, value in frame:
+            if ev_type == constants.ecodes.EV_KEY:
+                # In case of the key pressed is an modifier
+                if code in self.modifiers:
+                    if value:  # Pressing
+                        self.modifier = code
+                        continue
+
+                    # Releasing
+                    self.modifier = 0
+
+                    # We just propagate the shortcut event
+                    # when the modifier key is released to
+                    # prevent bug that stuck devices
+                    if self.event:
+                        event = self.event
+                        self.bus.publish(SHORTCUT, event)
+                        self.event = None
+                    continue
+
+                if self.modifier:  # A modifier is pressed
+                    if not value:  # The key is being released
+
+                        # Generate a key name as in "map" function defined above
+                        keys = [str(self.modifier), str(code)]
+                        shortcut = ' '.join(keys)
+
+                        # Check if shortcut name is in
+                        # mapped shortcuts list
+                        if shortcut in self.shortcuts:
+                            # Set the shortcut event to be sent on modifier key release
+                            self.event = self.shortcuts[shortcut]
+
+
+class FocusEvents(object):
     """
-    Keep references of clients and notify
-    all observers attached about changes
+    Keep references of clients and publish
+    the changes of the client in focus
     """
 
-    def __init__(self, *args, **kwargs):
-        Observer.__init__(self, *args, **kwargs)
+    def __init__(self, bus: EventBus):
+        self.bus = bus
 
-        # Define the clients data type
-        self._clients: Dict[AnyStr, asyncio.BaseTransport] = {}
-
-        # Generate the default identification and
-        # pass it as default to the _client
+        # Generate the default identification, the server
+        # starts the ring and is the default focus
         self.default_identification = "StrinoServer"
-        self._focus = self.default_identification
+        self.server = ClientHandle(self.default_identification, None, SERVER_HOST)
+        self._focus = self.server
+
+        # Handles by identification and by host
+        self._clients: Dict[AnyStr, ClientHandle] = {self.default_identification: self.server}
+        self._hosts: Dict[str, ClientHandle] = {SERVER_HOST: self.server}
 
-        # Register the default identification key and transport
-        self._clients[self.default_identification] = asyncio.BaseTransport()
+        # Place of every host seen, kept after it disconnects
+        self._ranks: Dict[str, int] = {SERVER_HOST: 0}
         constants.globals.logger.info(f"Added {self.default_identification} as default focus")
 
-    def register(self, name: AnyStr, transport: asyncio.BaseTransport):
+        bus.subscribe(SHORTCUT, self.switch)
+
+    @property
+    def focus(self) -> ClientHandle:
+        """ Client in focus """
+        return self._focus
+
+    def register(self, name: AnyStr, writer: networking.communication.FrameWriter,
+                 host: Optional[str] = None) -> ClientHandle:
         """ Register a client to send events """
-        self._clients[name] = transport
+
+        # Clients without host get a new place every time
+        key = host if host is not None else name
+        rank = self._ranks.setdefault(key, len(self._ranks))
+        client = ClientHandle(name, writer, host, rank)
+
+        # Link after the last handle with a lower rank, looked up
+        # backwards since new hosts go to the end of the ring
+        before = self.server.previous
+
+        while before is not self.server and before.rank > rank:
+            before = before.previous
+
+        client.previous = before
+        client.next = before.next
+        before.next.previous = client
+        before.next = client
+
+        self._clients[name] = client
+
+        if host is not None:
+            self._hosts[host] = client
+
         constants.globals.logger.info(f"Added {name} to sender list")
+        self.bus.publish(CLIENT_ADDED, client)
+        return client
+
+    def writers(self) -> List[networking.communication.FrameWriter]:
+        """ Frame writers of every connected client """
+        writers = []
+        client = self.server.next
+
+        while client is not self.server:
+            writers.append(client.writer)
+            client = client.next
+
+        return writers
 
     def forget(self, name: AnyStr):
         """ Remove a client from list of clients """
-        if name in self._clients:
-            constants.globals.logger.info(f"Removing {name} from sender list")
-            self._clients.pop(name)
+        client = self._clients.get(name)
+
+        if client is None or client is self.server:
+            return None
+
+        constants.globals.logger.info(f"Removing {name} from sender list")
+        self._clients.pop(name)
+
+        if client.host is not None and self._hosts.get(client.host) is client:
+            self._hosts.pop(client.host)
+
+        client.previous.next = client.next
+        client.next.previous = client.previous
+        self.bus.publish(CLIENT_REMOVED, client)
+
+        if client is self._focus:
             self.to_last_client()
 
+    def client(self, host: str) -> Optional[ClientHandle]:
+        """ Client connected from a host """
+        return self._hosts.get(host)
+
+    def focus_on(self, client: ClientHandle) -> None:
+        """ Change the focus to a client """
+        if client is self._focus:
+            return None
+
+        self._focus = client
+        constants.globals.logger.info(f"Focus moved to {client.identification}")
+        self.bus.publish(FOCUS, client)
+
     def to_last_client(self):
         """ Change the focus to the last client """
-        if len(self._clients):
-            identifications = list(self._clients.keys())
-            identification = identifications[-1]
-            self._focus = identification
-            constants.globals.logger.info(f"Focus moved to {self._focus}")
-
-            self.notify({
-                'identification': self._focus,
-                'transport': self._clients.get(self._focus)
-            })
+        self.focus_on(self.server.previous)
 
     def to_left(self):
         """ Change the focus to left """
-        names = list(self._clients.keys())
-        position = names.index(self._focus) - 1
+        self.focus_on(self._focus.previous)
 
-        if position >= 0:
-            try:
-                self._focus = names[position]
-                constants.globals.logger.info(f"Focus moved to {self._focus}")
-                self.notify({
-                    'identification': self._focus,
-                    'transport': self._clients.get(self._focus)
-                })
+    def to_right(self):
+        """ Change the focus to right """
+        self.focus_on(self._focus.next)
 
-            except (ValueError, IndexError):
-                pass
+    def switch(self, shortcut: AnyStr) -> None:
+        """ Move the focus when a focus shortcut is matched """
+        if shortcut == "FOCUS_SWITCH_RIGHT":
+            self.to_right()
 
-    def to_right(self):
-        """ Change the focus to left """
-        names = list(self._clients.keys())
-        position = names.index(self._focus) + 1
+        if shortcut == "FOCUS_SWITCH_LEFT":
+            self.to_left()
+
+
+class Router(object):
+    """
+    Keep the routing table of the devices sent to a given host
+    whatever the focus is. Devices are routed by name or by
+    vendor:product in hex (E.g: 046d:c52b). A routed device
+    stays local while its host is not connected, the others
+    follow the focus and are not in the table
+    """
+
+    def __init__(self, bus: EventBus, focus: FocusEvents, routes: Dict[str, str]):
+        self.bus = bus
+        self.focus = focus
+        self.routes = routes
+
+        # Client of every routed device by index. Readers look up
+        # the device of every frame here, so it is kept up to date
+        # instead of being built when a frame arrives
+        self.table: Dict[int, ClientHandle] = {}
+
+        # Host of every routed device by index
+        self._hosts: Dict[int, str] = {}
+
+        bus.subscribe(DEVICE_ADDED, self.add_device)
+        bus.subscribe(DEVICE_REMOVED, self.remove_device)
+        bus.subscribe(CLIENT_ADDED, self.connected)
+        bus.subscribe(CLIENT_REMOVED, self.disconnected)
+
+    def host(self, device: devices.physical.PhysicalDevice) -> Optional[str]:
+        """
+        Find the host a device is routed to
+        :param device: PhysicalDevice instance
+        :return: Host or None when the device follows the focus
+        """
+        host = self.routes.get(device.name)
+
+        if host is None:
+            info = device.info
+            host = self.routes.get(f"{info.get('vendor', 0):04x}:{info.get('product', 0):04x}")
+
+        return host
+
+    def add_device(self, device: devices.physical.PhysicalDevice) -> None:
+        """ Route a device when it is in the routes """
+        host = self.host(device)
 
-        if position <= len(self._focus):
-            try:
-                self._focus = names[position]
-                constants.globals.logger.info(f"Focus moved to {self._focus}")
-                self.notify({
-                    'identification': self._focus,
-                    'transport': self._clients.get(self._focus)
-                })
-            except (ValueError, IndexError):
-                pass
+        if host is None:
+            return None
 
-    def run(self) -> None:
-        while True:
-            data = self.queue.get()
-            who, event = data.values()
+        client = self.focus.client(host)
 
-            if who == "ShortcutListener":
-                shortcut = event.get('name')
+        self._hosts[device.index] = host
+        self.table[device.index] = client if client is not None else self.focus.server
+        constants.globals.logger.info(f"Device {device.name} is routed to {host}")
+        self.bus.publish(ROUTES, self.table)
 
-                if shortcut == "FOCUS_SWITCH_RIGHT":
-                    self.to_right()
+    def remove_device(self, device: devices.physical.PhysicalDevice) -> None:
+        """ Forget the route of a device unplugged """
 
-                if shortcut == "FOCUS_SWITCH_LEFT":
-                    self.to_left()
+        # No other device changes its route, so ROUTES is not
+        # published while the device is still being removed
+        if self._hosts.pop(device.index, None) is not None:
+            self.table.pop(device.index, None)
 
+    def _update(self, host: str, client: ClientHandle) -> None:
+        """ Route the devices of a host to a client """
+        changed = False
 
-class Grabber(Observer):
-    """ Grab devices based on focus """
+        for index, routed in self._hosts.items():
+            if routed == host:
+                self.table[index] = client
+                changed = True
 
-    def __init__(self, *args, **kwargs):
-        Observer.__init__(self, *args, **kwargs)
+        if changed:
+            self.bus.publish(ROUTES, self.table)
+
+    def connected(self, client: ClientHandle) -> None:
+        """ Send the devices routed to a host to the client connected from it """
+        if client.host is not None:
+            self._update(client.host, client)
+
+    def disconnected(self, client: ClientHandle) -> None:
+        """ Keep local the devices routed to a client gone """
+        if client.host is None:
+            return None
+
+        # Another connection from the same host may be left
+        other = self.focus.client(client.host)
+        self._update(client.host, other if other is not None else self.focus.server)
+
+
+class Grabber(object):
+    """
+    Grab every device sent to a client, the devices routed to
+    a client and the others while a client is in focus
+    """
+
+    def __init__(self, bus: EventBus, routes: Optional[Dict[int, ClientHandle]] = None):
 
         self._devices: List[devices.physical.PhysicalDevice] = []
 
+        # Clients of the routed devices by index, kept by a Router
+        self._routes = routes if routes is not None else {}
+
+        # Client in focus, the devices not routed follow it
+        self._focus: Optional[ClientHandle] = None
+
+        bus.subscribe(FOCUS, self.follow)
+        bus.subscribe(ROUTES, self.apply)
+        bus.subscribe(DEVICE_ADDED, self.plugged)
+        bus.subscribe(DEVICE_REMOVED, self.unplugged)
+
     def get_devices(self) -> List[devices.physical.PhysicalDevice]:
         """ Return a list of devices we are watching for grab """
         return self._devices
@@ -289,14 +502,72 @@ class Grabber(Observer):
             if not device.is_grabbed:
                 device.grab()
 
-    def run(self) -> None:
-        while True:
-            data = self.queue.get()
-            who, event = data.values()
+    def _wanted(self, device: devices.physical.PhysicalDevice) -> bool:
+        """ Whether the events of a device are sent to a client """
+        client = self._routes.get(device.index, self._focus)
+        return client is not None and client.host != SERVER_HOST
 
-            if who == 'FocusEvents':
-                if event.get('identification') == 'StrinoServer':
-                    self.release_all()
-                    continue
+    def apply(self, *_) -> None:
+        """ Grab the devices sent to a client and release the others """
+        for device in self._devices:
+
+            # Closed devices have nothing left to grab or release
+            if device.handler < 0:
+                continue
+
+            wanted = self._wanted(device)
+
+            if wanted and not device.is_grabbed:
+                device.grab()
+            elif not wanted and device.is_grabbed:
+                device.release()
+
+    def follow(self, client: ClientHandle) -> None:
+        """ Release devices while the server is in focus """
+        start = time.monotonic_ns()
+
+        # Moving between clients keeps the devices grabbed
+        self._focus = client
+        self.apply()
+
+        tracer = misc.tracing.tracer
+
+        if tracer is not None:
+            tracer.record('switch', start)
+
+    def plugged(self, device: devices.physical.PhysicalDevice) -> None:
+        """ Watch a device plugged, grabbing it if it is sent to a client """
+        self.add_device(device)
+
+        if self._wanted(device):
+            device.grab()
+
+    def unplugged(self, device: devices.physical.PhysicalDevice) -> None:
+        """ Stop watching a device unplugged """
+        if device in self._devices:
+            self._devices.remove(device)
+
+
+class DeviceAnnouncer(object):
+    """
+    Tell every connected client about devices plugged or
+    unplugged, one device at a time. Clients connecting later
+    get the devices shared at that moment when they connect
+    """
+
+    def __init__(self, bus: EventBus, focus: FocusEvents):
+        self.events = networking.communication.Events()
+        self.focus = focus
+
+        bus.subscribe(DEVICE_ADDED, self.added)
+        bus.subscribe(DEVICE_REMOVED, self.removed)
+
+    def _broadcast(self, data: bytes) -> None:
+        for writer in self.focus.writers():
+            writer.write(data)
+
+    def added(self, device: devices.physical.PhysicalDevice) -> None:
+        self._broadcast(self.events.generate("ADD_DEVICE", device.info))
 
-                self.grab_all()
+    def removed(self, device: devices.physical.PhysicalDevice) -> None:
+        self._broadcast(self.events.generate("REMOVE_DEVICE", device.info))
@@ -14,18 +14,24 @@
 # Author: Jeffersson Abreu (ctw6av)
 
 import networking.communication
-from threading import Thread
 import constants.globals
 import server.observers
-from typing import List
+import server.layout
+import events.bus
+from typing import Dict, List, Optional
 import devices.physical
+import devices.hotplug
+import misc.recording
+import misc.tracing
 import misc.utils
 import asyncio
+import signal
+import sys
 
 
 class TCPServer(asyncio.Protocol):
 
-    def __init__(self, focus: server.observers.FocusEvents, devinfo: List, *args, **kwargs):
+    def __init__(self, focus: server.observers.FocusEvents, devinfo: List, policy: str = 'coalesce', *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         # Generate an unique identification to the connection
@@ -33,22 +39,43 @@ class TCPServer(asyncio.Protocol):
         self.events = networking.communication.Events()
         self.devinfo = devinfo
         self.transport = None
+        self.writer = None
+        self.policy = policy
         self.focus = focus
 
     def connection_made(self, transport):
         addr, _ = transport.get_extra_info('peername')
         constants.globals.logger.info(f'New connection from {addr}')
         constants.globals.logger.info(f'Connection identified as {self.identification}')
-        self.focus.register(self.identification, transport)
-        event = self.events.generate("CREATE_DEVICE", self.devinfo)
         self.transport = transport
+
+        # Device frames are batched per event loop iteration. Writing
+        # may pause the transport right away, so the writer is made
+        # before anything is written
+        self.writer = networking.communication.FrameWriter(transport, policy=self.policy)
+
+        # Pause early so stale motion never waits long in the transport
+        # buffer, it waits in the writer where it can be merged
+        transport.set_write_buffer_limits(high=networking.communication.WRITE_BUFFER_HIGH)
+
+        event = self.events.generate("CREATE_DEVICE", self.devinfo)
         transport.write(event)
+        self.focus.register(self.identification, self.writer, addr)
 
     def data_received(self, data):
         # All communication is made by events. The
         # events are generated and handled by Events
         # class defined at module "networking"
-        self.events.handle(data)
+        self.events.handle(data, self)
+
+    def pause_writing(self) -> None:
+        # The client is not reading as fast as we write
+        constants.globals.logger.debug(f"Connection with '{self.identification}' is congested")
+        self.writer.pause()
+
+    def resume_writing(self) -> None:
+        constants.globals.logger.debug(f"Connection with '{self.identification}' is drained")
+        self.writer.resume()
 
     def connection_lost(self, exc) -> None:
         constants.globals.logger.info(f"Connection with '{self.identification}' was lost")
@@ -59,53 +86,102 @@ class TCPServer(asyncio.Protocol):
         self.transport.close()
 
 
-def start_server(addr, port, handlers: List):
-
-    # Instantiate observers
-    shortcut = server.observers.ShortcutListener()
-    sender = server.observers.EventSender()
-    focus = server.observers.FocusEvents()
-    grabber = server.observers.Grabber()
-
-    # This is the most important thing using
-    # observers, the way we attach then each
-    # others resume all the program fluxing
-    focus.attach(grabber)
-    focus.attach(sender)
+def start_server(addr, port, handlers: List, reader: str = 'loop', trace: bool = False, backend=None,
+                 record: Optional[str] = None, replay: Optional[str] = None, speed: float = 1.0,
+                 names: Optional[List[str]] = None, filters: Optional[Dict] = None,
+                 screens: Optional[List] = None, routes: Optional[Dict[str, str]] = None,
+                 broadcast: bool = False, policy: str = 'coalesce'):
 
-    # TODO: Remove in a future release when focus
-    #       gonna change based on mouse pointer
-    shortcut.attach(focus)
+    # Generating default main loop
+    loop = asyncio.get_event_loop()
 
-    devices_info = list()
+    if trace:
+        # Latencies are written to the log on SIGUSR1 and on exit
+        tracer = misc.tracing.enable(misc.tracing.SERVER_STAGES)
+        loop.add_signal_handler(signal.SIGUSR1, tracer.log)
+
+    # Every observer runs in the event loop thread. Reading devices
+    # from the event loop too keeps frames in that thread, otherwise
+    # each device thread hands its frames over to the loop
+    threaded = reader == 'thread'
+    constants.globals.logger.info(f"Reading devices from {'threads' if threaded else 'the event loop'}")
+
+    bus = events.bus.EventBus(loop)
+
+    # This is the most important thing using the
+    # bus, the order observers subscribe to topics
+    # resume all the program fluxing. The bus calls
+    # them right away, one after another
+
+    # Focus moves with the shortcuts and, when the screens
+    # are laid out, with the mouse pointer crossing their edges
+    focus = server.observers.FocusEvents(bus)
+    layout = server.layout.ScreenLayout(screens or [])
+
+    # Devices sent to a given client whatever the focus is
+    router = server.observers.Router(bus, focus, routes or {})
+
+    if layout:
+        # Tracks frames before they are sent, so the frame
+        # crossing an edge already goes to the next screen
+        server.layout.PointerTracker(bus, focus, layout, router.table)
+
+    if broadcast:
+        constants.globals.logger.info("Broadcasting frames to every client")
+
+    sender = server.observers.EventSender(bus, router.table, broadcast)
+
+    # Shortcuts are matched after the frame is sent, so the modifier
+    # release moving the focus still reaches the client it left
+    shortcut = server.observers.ShortcutListener(bus)
+    grabber = server.observers.Grabber(bus, router.table)
+    server.observers.DeviceAnnouncer(bus, focus)
+
+    # Shared devices, including the ones plugged while running
+    hotplug = devices.hotplug.Hotplug(bus, names or [], backend, threaded, filters)
+    devices_info = hotplug.devices_info
+    player = None
+
+    if replay is not None:
+        # Frames come from a recording instead of devices
+        recording = misc.recording.Recording(replay)
+        devices_info.extend(recording.devices)
+        player = misc.recording.Player(recording, bus, speed)
+        handlers = []
+
+    for index, handler in enumerate(handlers):
+        # The index identifies the device in every message sent to clients
+        try:
+            device = devices.physical.PhysicalDevice(handler, index, backend)
+        except OSError as error:
+            constants.globals.logger.fatal("Error while opening device handler file")
+            constants.globals.logger.fatal(error.__class__)
+            sys.exit(127)
+
+        # Start reading device events and add the device to grabber list
+        hotplug.add(device, loop)
+        router.add_device(device)
+        grabber.add_device(device)
 
-    for handler in handlers:
-        # Start the threads that read device events
-        device = devices.physical.PhysicalDevice(handler)
+    if replay is None:
+        hotplug.watch(loop)
 
-        # Fill devices info
-        devices_info.append(device.info)
+    recorder = None
 
-        # Once again we attach the observers to
-        # devices. The observers can be attached
-        # to each other and also to classes that
-        # inherits from "Subject" interface
-        device.attach(shortcut)
-        device.attach(sender)
+    if record is not None:
+        recorder = misc.recording.Recorder(record, bus, devices_info)
 
-        # Add the device to grabber list
-        grabber.add_device(device)
+    def connection():
+        # The replay waits for the first client, frames
+        # played before it would not be sent anywhere
+        if player is not None:
+            player.start(loop)
 
-        # Start device reading events as daemon
-        p = Thread(target=device.read, daemon=True)
-        p.start()
-
-    # Generating default main loop
-    loop = asyncio.get_event_loop()
+        return TCPServer(focus, devices_info, policy)
 
     # Each client connection will create a new server instance
     constants.globals.logger.info(f"Starting server at {addr}:{port}")
-    coro = loop.create_server(lambda: TCPServer(focus, devices_info), addr, port)
+    coro = loop.create_server(connection, addr, port)
     waiter = loop.run_until_complete(coro)
     constants.globals.logger.info(f"Server started successful")
 
@@ -114,6 +190,13 @@ def start_server(addr, port, handlers: List):
     except KeyboardInterrupt:
         constants.globals.logger.info('Server stop required')
         grabber.release_all()
+        hotplug.close()
+
+        if recorder is not None:
+            recorder.close()
+
+        if misc.tracing.tracer is not None:
+            misc.tracing.tracer.log()
 
         # Close the server
         waiter.close()
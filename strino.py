@@ -17,6 +17,8 @@ from server.server import start_server
 from client.client import connect_to
 import constants.globals
 import devices.physical
+import devices.virtual
+import networking.communication
 import misc.functions
 import configparser
 import argparse
@@ -38,6 +40,11 @@ if __name__ == '__main__':
     port = keys.getint('port')
     addr = keys.get('addr')
     tp = keys.get('type')
+    reader = keys.get('reader', 'loop')
+    trace = keys.getboolean('trace', False)
+    creation = keys.get('creation', 'parallel')
+    broadcast = keys.getboolean('broadcast', False)
+    policy = keys.get('policy', 'coalesce')
 
     # Get default devices in settings
     dev_section = config['STRINO_DEVICES']
@@ -46,6 +53,21 @@ if __name__ == '__main__':
     names = [dev_section.get(device) for device in dev_section]
     handlers = misc.functions.get_handlers_by_devices_name(names)
 
+    # Events dropped from the devices, before reaching any client
+    filters = {}
+    if config.has_section('STRINO_FILTERS'):
+        filters = misc.functions.get_event_filters(config['STRINO_FILTERS'])
+
+    # Screens the mouse pointer moves the focus between
+    screens = []
+    if config.has_section('STRINO_LAYOUT'):
+        screens = misc.functions.get_screen_layout(config['STRINO_LAYOUT'])
+
+    # Devices sent to a given host whatever the focus is
+    routes = {}
+    if config.has_section('STRINO_ROUTES'):
+        routes = misc.functions.get_device_routes(config['STRINO_ROUTES'])
+
     parser = argparse.ArgumentParser(description='Share your IO in unix like operating systems with Strino.')
     parser.add_argument('-d', '--devices', help='List devices handlers to share', nargs='*', type=str, default=handlers)
     parser.add_argument('-v', '--verbose', help='Increase the output verbosity', action="store_true", default=verbose)
@@ -53,6 +75,19 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--port', help='Enter the server port to connect', type=int, default=port)
     parser.add_argument('-l', '--list', help='List of available devices to share', action="store_true")
     parser.add_argument('-t', '--type', help='Enter the type (server or client)', type=str, default=tp)
+    parser.add_argument('-r', '--reader', help='How devices are read (loop or thread)', type=str,
+                        choices=['loop', 'thread'], default=reader)
+    parser.add_argument('--trace', help='Trace latencies, dumped to the log on SIGUSR1', action="store_true",
+                        default=trace)
+    parser.add_argument('-c', '--creation', help='How clients create virtual devices (inline, parallel or lazy)',
+                        type=str, choices=devices.virtual.CREATION_MODES, default=creation)
+    parser.add_argument('-b', '--broadcast', help='Send the frames to every client at once', action="store_true",
+                        default=broadcast)
+    parser.add_argument('--policy', help='What slow clients do with motion piling up (coalesce or drop)',
+                        type=str, choices=networking.communication.WRITE_POLICIES, default=policy)
+    parser.add_argument('--record', help='Record the frames read from devices to a file', type=str)
+    parser.add_argument('--replay', help='Serve the frames of a recording instead of devices', type=str)
+    parser.add_argument('--speed', help='Replay speed, as fast as possible when 0', type=float, default=1.0)
 
     args = parser.parse_args()
 
@@ -69,7 +104,13 @@ if __name__ == '__main__':
     if args.list:
         handlers_mixed = misc.functions.get_all_devices_handlers()
         handlers_sorted = misc.utils.natural_sort(handlers_mixed)
-        devices_list = [devices.physical.PhysicalDevice(handler) for handler in handlers_sorted]
+
+        try:
+            devices_list = [devices.physical.PhysicalDevice(handler) for handler in handlers_sorted]
+        except OSError as error:
+            constants.globals.logger.fatal("Error while opening device handler file")
+            constants.globals.logger.fatal(error.__class__)
+            sys.exit(127)
 
         print(
             """
@@ -104,7 +145,10 @@ if __name__ == '__main__':
                     os.path.join('/dev/input', device)
                 )
 
-            start_server(args.addr, args.port, filtered_devices)
+            start_server(args.addr, args.port, filtered_devices, reader=args.reader, trace=args.trace,
+                         record=args.record, replay=args.replay, speed=args.speed, names=names,
+                         filters=filters, screens=screens, routes=routes, broadcast=args.broadcast,
+                         policy=args.policy)
 
         if args.type == 'client':
-            connect_to(addr=args.addr, port=args.port)
+            connect_to(addr=args.addr, port=args.port, trace=args.trace, creation=args.creation)
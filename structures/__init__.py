@@ -14,8 +14,10 @@
 # Author: Jeffersson Abreu (ctw6av)
 
 __all__ = [
+    'bitset',
     'ifaddrs',
     'input',
     'uinput',
+    'frame',
     'time'
 ]
@@ -0,0 +1,94 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.
+#
+# Author: Jeffersson Abreu (ctw6av)
+
+from typing import Iterable, Iterator
+
+
+# Bits set in every possible byte. Walking the bitmap a byte at
+# a time with this table is faster than big integer tricks once
+# bitmaps get as long as the key codes one
+_BYTE_BITS = [tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256)]
+
+
+class Bitset(object):
+    """
+    Set of small non negative integers (event types, key codes,
+    input properties...) kept as a kernel bitmap, bit n of byte
+    n // 8 for every member n. Bitmaps are taken as returned by
+    EVIOCGBIT and friends, so building one costs nothing and
+    the members are only found when iterating
+    """
+
+    __slots__ = ('raw',)
+
+    def __init__(self, raw: bytes = b''):
+
+        # Trailing empty bytes are dropped, a keyboard bitmap
+        # is as long as its highest key instead of KEY_MAX bits
+        self.raw = bytes(raw).rstrip(b'\0')
+
+    @classmethod
+    def from_bits(cls, bits: Iterable[int]) -> 'Bitset':
+        """
+        Build a bitset holding some members
+        :param bits: Members of the bitset
+        :return: Bitset instance
+        """
+        value = 0
+
+        for bit in bits:
+            value |= 1 << bit
+
+        return cls(value.to_bytes((value.bit_length() + 7) // 8, 'little'))
+
+    def __int__(self) -> int:
+        return int.from_bytes(self.raw, 'little')
+
+    def __contains__(self, bit: int) -> bool:
+        byte = bit >> 3
+        return byte < len(self.raw) and bool(self.raw[byte] & (1 << (bit & 7)))
+
+    def __iter__(self) -> Iterator[int]:
+        """ Members in ascending order, empty bytes are skipped """
+        table = _BYTE_BITS
+        return iter([
+            base + bit for base, byte in zip(range(0, len(self.raw) * 8, 8), self.raw) if byte for bit in table[byte]
+        ])
+
+    def __len__(self) -> int:
+        return bin(int(self)).count('1')
+
+    def __bool__(self) -> bool:
+        return bool(self.raw)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Bitset):
+            return self.raw == other.raw
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(self.raw)
+
+    def __reduce__(self):
+        # Pickled as the bitmap alone
+        return Bitset, (self.raw,)
+
+    def __repr__(self) -> str:
+        return f"Bitset({list(self)})"
+
+
+__all__ = [
+    'Bitset'
+]
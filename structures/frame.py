@@ -0,0 +1,147 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.
+#
+# Author: Jeffersson Abreu (ctw6av)
+
+from typing import Dict, Iterator, Tuple
+import constants.ecodes
+import structures.input
+import ctypes
+import struct
+
+
+# Size of a single struct input_event
+EVENT_SIZE = ctypes.sizeof(structures.input.InputEvent)
+
+# Where type, code and value start in a struct input_event
+TYPE_OFFSET = structures.input.InputEvent.type.offset
+
+# Layout of the fields we care about, the timeval is skipped
+EVENT_FORMAT = f'{TYPE_OFFSET}xHHi'
+
+# Packs the fields following the timeval of a single event
+EVENT_FIELDS = struct.Struct('HHi')
+
+# Struct instances able to unpack a given number of events
+_layouts: Dict[int, struct.Struct] = {}
+
+
+def _layout(count: int) -> struct.Struct:
+    """
+    Get a struct unpacking type, code and value of count events
+    :param count: Number of events in the buffer
+    :return: Cached struct.Struct instance
+    """
+    layout = _layouts.get(count)
+
+    if layout is None:
+        layout = _layouts[count] = struct.Struct(EVENT_FORMAT * count)
+
+    return layout
+
+
+class Frame(object):
+    """
+    Events read from a device between two EV_SYN events. The
+    packed events are decoded once when the frame is built and
+    shared by everyone receiving it, so a frame must never be
+    changed after it is published
+    """
+
+    __slots__ = ('index', 'raw', 'events', 'stamp')
+
+    def __init__(self, index: int, raw: bytes, stamp: int = 0):
+
+        # Index of the device the frame was read from
+        self.index = index
+
+        # Value of time.monotonic_ns when the frame was read,
+        # only taken while latency tracing is enabled
+        self.stamp = stamp
+
+        # Packed struct input_event as read from the kernel
+        # and forwarded to clients without being packed again
+        self.raw = raw
+
+        # Type, code and value of every event one after another
+        self.events: Tuple[int, ...] = _layout(len(raw) // EVENT_SIZE).unpack(raw)
+
+    @property
+    def types(self) -> Tuple[int, ...]:
+        """ Type of every event in the frame """
+        return self.events[0::3]
+
+    @property
+    def codes(self) -> Tuple[int, ...]:
+        """ Code of every event in the frame """
+        return self.events[1::3]
+
+    @property
+    def values(self) -> Tuple[int, ...]:
+        """ Value of every event in the frame """
+        return self.events[2::3]
+
+    def __len__(self) -> int:
+        return len(self.events) // 3
+
+    def __iter__(self) -> Iterator[Tuple[int, int, int]]:
+        """ Iterate over (type, code, value) of every event """
+        fields = iter(self.events)
+        return zip(fields, fields, fields)
+
+
+def is_motion(frame: Frame) -> bool:
+    """
+    Check if a frame only holds relative motion (REL_X, REL_Y,
+    REL_WHEEL...) that can be summed with other motion frames
+    :param frame: Frame instance
+    :return: Bool
+    """
+    types = frame.types
+    return bool(types) and types.count(constants.ecodes.EV_REL) == len(types)
+
+
+def coalesce(first: Frame, second: Frame) -> Frame:
+    """
+    Merge two motion frames of the same device into a single one
+    holding the sum of their relative values for every code
+    :param first: Older motion frame
+    :param second: Newer motion frame
+    :return: New frame with the timeval of the newer one, keeping
+             the stamp (time it was read) of the first one
+    """
+    totals: Dict[int, int] = {}
+
+    for _, code, value in first:
+        totals[code] = totals.get(code, 0) + value
+
+    for _, code, value in second:
+        totals[code] = totals.get(code, 0) + value
+
+    # Reuse the timeval of the newest event
+    stamp = second.raw[-EVENT_SIZE:-EVENT_SIZE + TYPE_OFFSET]
+    pack = EVENT_FIELDS.pack
+    rel = constants.ecodes.EV_REL
+
+    raw = b''.join([stamp + pack(rel, code, value) for code, value in totals.items()])
+
+    # The merged frame is as late as its oldest part
+    return Frame(second.index, raw, first.stamp)
+
+
+__all__ = [
+    'EVENT_SIZE',
+    'is_motion',
+    'coalesce',
+    'Frame'
+]
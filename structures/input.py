@@ -52,6 +52,19 @@ class ABSInfo(ctypes.Structure):
     ]
 
 
+class InputMask(ctypes.Structure):
+    """
+    Struct input_mask - used by EVIOCSMASK. The codes of the
+    event type whose bit is set in the bitmap at codes_ptr are
+    delivered to the file handle, the others are dropped
+    """
+    _fields_ = [
+        ('type', ctypes.c_uint32),          # event type, 0 masks the event types themselves
+        ('codes_size', ctypes.c_uint32),    # size of the bitmap in bytes
+        ('codes_ptr', ctypes.c_uint64),     # address of the bitmap
+    ]
+
+
 class InputEvent(ctypes.Structure):
     """
     Struct input_event represents a device input
@@ -66,6 +79,7 @@ class InputEvent(ctypes.Structure):
 
 __all__ = [
     'InputEvent',
+    'InputMask',
     'InputId',
     'ABSInfo'
 ]